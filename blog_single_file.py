@@ -1,24 +1,132 @@
-from flask import Flask, render_template, url_for, flash, redirect, request, abort
+from flask import Flask, render_template, url_for, flash, redirect, request, abort, g, session, make_response, jsonify, \
+    send_from_directory, Response, stream_with_context, has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, current_user, logout_user, login_required
 from flask_bcrypt import Bcrypt
-from datetime import datetime
+from sqlalchemy import DDL, event, insert, select, text, tuple_, update
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import defer, joinedload, make_transient_to_detached
+from jinja2 import ChoiceLoader, DictLoader
+from markupsafe import Markup, escape
+from PIL import Image, ImageOps, UnidentifiedImageError
+from datetime import datetime, timedelta
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+import base64
+import bleach
+import click
+import csv
+import gzip
+import hashlib
+import itertools
+import json
+import markdown
+import mimetypes
+import random
+import re
 import os
-from werkzeug.utils import secure_filename
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.serving import make_server
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///blog.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('BLOG_DATABASE_URI', 'sqlite:///blog.db')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+database_url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+# A SQLite file connection cannot go stale, so only server databases pay for a ping on checkout
+if database_url.get_backend_name() != 'sqlite':
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_pre_ping'] = True
+# In-memory SQLite gets a single shared connection (StaticPool), which takes no pool sizing
+if database_url.get_backend_name() != 'sqlite' or database_url.database not in (None, '', ':memory:'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=int(os.environ.get('BLOG_DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('BLOG_DB_MAX_OVERFLOW', 10)),
+    )
+# WAL lets readers run alongside a writer; busy_timeout makes writers wait for the lock instead of failing
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('BLOG_SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('BLOG_SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('BLOG_SQLITE_SYNCHRONOUS', 'NORMAL')
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024  # 2MB max file size
+app.config['AVATAR_FOLDER'] = os.path.join(app.root_path, 'static', 'avatars')
+app.config['AVATAR_MAX_AGE'] = 365 * 24 * 3600  # avatar files are content-addressed, so never change
+app.config['AVATAR_MAX_DIMENSION'] = 4096  # wider or taller uploads are rejected before decoding
+app.config['POSTS_PER_PAGE'] = 5
+app.config['PAGINATION_MODE'] = 'cursor'  # 'cursor' or 'numbered'
+app.config['POST_COUNT_TTL'] = 60  # seconds a cached post total stays valid
+app.config['PAGE_CACHE_TTL'] = 300
+app.config['PAGE_CACHE_SIZE'] = 1024  # max cached pages/fragments per process
+app.config['PAGE_CACHE_ENABLED'] = True  # off renders every page, fragment and feed from the database
+app.config['SEARCH_RESULTS_PER_PAGE'] = 10
+app.config['API_MAX_PER_PAGE'] = 100
+app.config['EXPORT_BATCH_SIZE'] = 1000  # rows fetched per round trip by the NDJSON export
+app.config['SLOW_REQUEST_MS'] = int(os.environ.get('BLOG_SLOW_REQUEST_MS', 500))  # 0 disables the slow-request log
+app.config['ASSET_FOLDER'] = os.path.join(app.root_path, 'static', 'assets')
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600
+app.config['GZIP_MIN_SIZE'] = 1024  # smallest dynamic response worth compressing, in bytes
+app.config['FEED_SIZE'] = 20
+# Canonical origin for absolute URLs in feeds and sitemaps, e.g. https://blog.example.com. When unset they
+# follow the request's Host header, and cached copies are kept per host.
+app.config['SITE_URL'] = os.environ.get('BLOG_SITE_URL')
+# Login attempts allowed per bucket: a burst, then a steady refill
+app.config['LOGIN_RATE_LIMIT'] = True
+app.config['LOGIN_IP_BURST'] = 20
+app.config['LOGIN_IP_PER_MINUTE'] = 10
+app.config['LOGIN_ACCOUNT_BURST'] = 5
+app.config['LOGIN_ACCOUNT_PER_MINUTE'] = 1
+app.config['RATE_LIMIT_KEYS'] = 100000  # buckets kept in memory before the least recently used are dropped
+# Reverse proxies in front of the app that append to X-Forwarded-For. Without this every client
+# behind a proxy shares its address, and so one per-IP login bucket.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('BLOG_TRUSTED_PROXIES', 0))
+app.config['FEED_CACHE_TTL'] = 24 * 3600  # feeds are invalidated by post writes, so this is only a backstop
+app.config['SITEMAP_MAX_URLS'] = 50000  # per sitemap file, the protocol's limit
+app.config['BCRYPT_LOG_ROUNDS'] = 12  # pick with `flask calibrate-bcrypt`
+app.config['PASSWORD_HASH_WORKERS'] = 2  # concurrent bcrypt operations per process
+app.config['USER_CACHE_TTL'] = 300
+app.config['USER_CACHE_SIZE'] = 10000
+
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
 
 db = SQLAlchemy(app)
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+    cursor.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.close()
 bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+AVATAR_SIZES = {'list': 64, 'profile': 250}
+EXCERPT_LENGTH = 200
+# Bump when the Markdown renderer or its settings change, then run `flask render-posts`
+MARKDOWN_RENDER_VERSION = 1
+MARKDOWN_TAGS = ['p', 'br', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'strong', 'em', 'del', 'a', 'img',
+                 'ul', 'ol', 'li', 'blockquote', 'code', 'pre', 'table', 'thead', 'tbody', 'tr', 'th', 'td']
+MARKDOWN_ATTRIBUTES = {'a': ['href', 'title'], 'img': ['src', 'alt', 'title'], 'th': ['align'], 'td': ['align']}
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
@@ -26,6 +134,8 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(120), unique=True, nullable=False)
     image_file = db.Column(db.String(20), nullable=False, default='default.jpg')
     password = db.Column(db.String(60), nullable=False)
+    # Maintained by new_post()/delete_post() and the bulk inserts; `flask repair-post-counts` recomputes it
+    post_count = db.Column(db.Integer, nullable=False, default=0)
     posts = db.relationship('Post', backref='author', lazy=True)
 
     def __repr__(self):
@@ -36,19 +146,682 @@ class Post(db.Model):
     title = db.Column(db.String(100), nullable=False)
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     content = db.Column(db.Text, nullable=False)
+    excerpt = db.Column(db.String(EXCERPT_LENGTH), nullable=False, default='')
+    # Sanitized HTML rendered from content on save; render_version 0 means not rendered yet
+    body_html = db.Column(db.Text, nullable=False, default='')
+    render_version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     def __repr__(self):
         return f"Post('{self.title}', '{self.date_posted}')"
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+# Listings sort by (date_posted, id), optionally filtered by author
+db.Index('ix_post_user_id_date_posted', Post.user_id, Post.date_posted.desc(), Post.id.desc())
+db.Index('ix_post_date_posted_id', Post.date_posted.desc(), Post.id.desc())
+
+# Schema changes for existing databases, applied in order and tracked in PRAGMA user_version
+MIGRATIONS = [
+    [
+        'CREATE INDEX IF NOT EXISTS ix_post_user_id_date_posted ON post (user_id, date_posted DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS ix_post_date_posted_id ON post (date_posted DESC, id DESC)',
+    ],
+    [
+        'ALTER TABLE post ADD COLUMN updated_at DATETIME',
+        'UPDATE post SET updated_at = date_posted',
+    ],
+    [
+        'CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(title, content)',
+        'DELETE FROM post_fts',
+        'INSERT INTO post_fts (rowid, title, content) SELECT id, title, content FROM post',
+    ],
+    [
+        "ALTER TABLE post ADD COLUMN excerpt VARCHAR(200) NOT NULL DEFAULT ''",
+        f'UPDATE post SET excerpt = substr(content, 1, {EXCERPT_LENGTH})',
+    ],
+    [
+        'ALTER TABLE user ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0',
+        'UPDATE user SET post_count = (SELECT count(*) FROM post WHERE post.user_id = user.id)',
+    ],
+    [
+        "ALTER TABLE post ADD COLUMN body_html TEXT NOT NULL DEFAULT ''",
+        'ALTER TABLE post ADD COLUMN render_version INTEGER NOT NULL DEFAULT 0',
+    ],
+]
+
+def migrate_db():
+    fresh = not db.inspect(db.engine).has_table('post')
+    db.create_all()
+    with db.engine.begin() as conn:
+        version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+        # create_all() already built the current schema, so a new database starts up to date
+        if fresh:
+            version = len(MIGRATIONS)
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                conn.exec_driver_sql(statement)
+            print(f"Applied migration {number}")
+        conn.exec_driver_sql(f'PRAGMA user_version = {max(version, len(MIGRATIONS))}')
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create missing tables and apply pending schema migrations."""
+    migrate_db()
+
+# Full-text search. post_fts mirrors title/content keyed by post id and is kept
+# in sync by mapper events, so every ORM write to Post updates the index too.
+event.listen(Post.__table__, 'after_create',
+             DDL('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(title, content)'))
+event.listen(Post.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS post_fts'))
+
+@event.listens_for(Post, 'after_insert')
+def index_new_post(mapper, connection, post):
+    connection.execute(text('INSERT INTO post_fts (rowid, title, content) VALUES (:id, :title, :content)'),
+                       {'id': post.id, 'title': post.title, 'content': post.content})
+
+@event.listens_for(Post, 'after_update')
+def reindex_post(mapper, connection, post):
+    connection.execute(text('DELETE FROM post_fts WHERE rowid = :id'), {'id': post.id})
+    index_new_post(mapper, connection, post)
+
+@event.listens_for(Post, 'after_delete')
+def unindex_post(mapper, connection, post):
+    connection.execute(text('DELETE FROM post_fts WHERE rowid = :id'), {'id': post.id})
+
+def rebuild_search_index():
+    with db.engine.begin() as conn:
+        conn.execute(text('DELETE FROM post_fts'))
+        conn.execute(text('INSERT INTO post_fts (rowid, title, content) SELECT id, title, content FROM post'))
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Repopulate the full-text index from the post table."""
+    rebuild_search_index()
+
+def change_post_count(user_id, delta):
+    # Increment in SQL so concurrent writers can't lose updates
+    db.session.execute(update(User).where(User.id == user_id).values(post_count=User.post_count + delta))
+
+@app.cli.command('repair-post-counts')
+def repair_post_counts_command():
+    """Recompute every user's post_count from the post table."""
+    with db.engine.begin() as conn:
+        conn.execute(text('UPDATE user SET post_count = (SELECT count(*) FROM post WHERE post.user_id = user.id)'))
+
+def fts_query(terms):
+    # Quote every term so user input can't trip FTS5 query syntax; terms are ANDed
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms.split())
+
+def highlight(snippet):
+    return escape(snippet).replace('\x02', Markup('<mark>')).replace('\x03', Markup('</mark>'))
+
+def search_posts(terms, after=None):
+    per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+    match = fts_query(terms)
+    if not match:
+        return [], None
+    sql = "SELECT rowid, rank, snippet(post_fts, -1, char(2), char(3), '...', 16) FROM post_fts WHERE post_fts MATCH :match"
+    params = {'match': match, 'limit': per_page + 1}
+    if after:
+        params['rank'], params['id'] = decode_search_cursor(after)
+        sql += ' AND (rank > :rank OR (rank = :rank AND rowid > :id))'
+    rows = db.session.execute(text(sql + ' ORDER BY rank, rowid LIMIT :limit'), params).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = encode_search_cursor(rows[per_page - 1][1], rows[per_page - 1][0])
+    rows = rows[:per_page]
+    posts = {post.id: post for post in listing_query().filter(Post.id.in_([row[0] for row in rows]))}
+    results = [(posts[row[0]], highlight(row[2])) for row in rows if row[0] in posts]
+    return results, next_cursor
+
+def post_query():
+    # Load each post's author in the same SELECT so listings don't issue one query per row
+    return Post.query.options(joinedload(Post.author))
+
+def listing_query():
+    # Listings show the stored excerpt, so never pull the full body
+    return post_query().options(defer(Post.content), defer(Post.body_html))
+
+def make_excerpt(content):
+    return content[:EXCERPT_LENGTH]
+
+def render_markdown(content):
+    html = markdown.markdown(content, extensions=['fenced_code', 'tables', 'nl2br'])
+    return bleach.clean(html, tags=MARKDOWN_TAGS, attributes=MARKDOWN_ATTRIBUTES, strip=True)
+
+def set_post_content(post, content):
+    post.content = content
+    post.excerpt = make_excerpt(content)
+    post.body_html = render_markdown(content)
+    post.render_version = MARKDOWN_RENDER_VERSION
+
+@app.cli.command('render-posts')
+@click.option('--all', 'render_all', is_flag=True, help='Re-render every post, not just outdated ones.')
+@click.option('--batch-size', default=500, show_default=True)
+def render_posts_command(render_all, batch_size):
+    """Render stored post HTML for posts saved by an older renderer (or never rendered)."""
+    last_id, rendered = 0, 0
+    # The served HTML changes, so updated_at moves too; ETags, Last-Modified and feeds are built from it
+    now = datetime.utcnow()
+    while True:
+        query = select(Post.id, Post.content).where(Post.id > last_id).order_by(Post.id).limit(batch_size)
+        if not render_all:
+            query = query.where(Post.render_version != MARKDOWN_RENDER_VERSION)
+        rows = db.session.execute(query).all()
+        if not rows:
+            break
+        db.session.execute(text('UPDATE post SET body_html = :html, render_version = :version, updated_at = :now '
+                                'WHERE id = :id'), [
+            {'id': row.id, 'html': render_markdown(row.content), 'version': MARKDOWN_RENDER_VERSION, 'now': now}
+            for row in rows])
+        db.session.commit()
+        last_id = rows[-1].id
+        rendered += len(rows)
+        print(f"Rendered {rendered} posts")
+
+class CursorPage:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+def pack_cursor(*parts):
+    raw = '|'.join(parts).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def unpack_cursor(cursor):
+    return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|')
+
+def encode_cursor(post):
+    return pack_cursor(post.date_posted.isoformat(), str(post.id))
+
+def decode_cursor(cursor):
+    try:
+        date_posted, post_id = unpack_cursor(cursor)
+        return datetime.fromisoformat(date_posted), int(post_id)
+    except ValueError:
+        abort(400)
+
+def encode_search_cursor(rank, post_id):
+    return pack_cursor(repr(rank), str(post_id))
+
+def decode_search_cursor(cursor):
+    try:
+        rank, post_id = unpack_cursor(cursor)
+        return float(rank), int(post_id)
+    except ValueError:
+        abort(400)
+
+def paginate_keyset(query, after=None, before=None, per_page=None):
+    # Seek on (date_posted, id) instead of OFFSET so deep pages cost the same as the first one
+    per_page = per_page or app.config['POSTS_PER_PAGE']
+    key = tuple_(Post.date_posted, Post.id)
+    if before:
+        posts = query.filter(key > decode_cursor(before))\
+            .order_by(Post.date_posted.asc(), Post.id.asc())\
+            .limit(per_page + 1).all()
+        has_prev, has_next = len(posts) > per_page, True
+        posts = posts[:per_page][::-1]
+    else:
+        if after:
+            query = query.filter(key < decode_cursor(after))
+        posts = query.order_by(Post.date_posted.desc(), Post.id.desc())\
+            .limit(per_page + 1).all()
+        has_prev, has_next = after is not None, len(posts) > per_page
+        posts = posts[:per_page]
+    if not posts:
+        return CursorPage(posts)
+    return CursorPage(posts,
+                      next_cursor=encode_cursor(posts[-1]) if has_next else None,
+                      prev_cursor=encode_cursor(posts[0]) if has_prev else None)
+
+post_totals = {}
+
+def cached_post_total(key, query):
+    cached = post_totals.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    total = query.order_by(None).with_entities(db.func.count(Post.id)).scalar()
+    post_totals[key] = (total, time.monotonic() + app.config['POST_COUNT_TTL'])
+    return total
+
+def forget_post_totals():
+    post_totals.pop('all', None)
+
+def paginate_posts(query, total):
+    # total is only called in numbered mode
+    if app.config['PAGINATION_MODE'] == 'numbered':
+        page = request.args.get('page', 1, type=int)
+        posts = query.order_by(Post.date_posted.desc(), Post.id.desc())\
+            .paginate(page=page, per_page=app.config['POSTS_PER_PAGE'], count=False)
+        posts.total = total()
+        return posts
+    return paginate_keyset(query, after=request.args.get('after'), before=request.args.get('before'))
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Avatars are stored as square JPEG thumbnails named after the upload's hash
+# (<hash>-<size>.jpg); User.image_file holds the hash. Re-encoding drops EXIF and other metadata.
+def save_avatar(file):
+    folder = app.config['AVATAR_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    fd, upload_path = tempfile.mkstemp(dir=folder, suffix='.upload')
+    os.close(fd)
+    try:
+        file.save(upload_path)
+        digest = hashlib.sha256()
+        with open(upload_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(chunk)
+        name = digest.hexdigest()[:20]
+        with Image.open(upload_path) as image:
+            # Opening only reads the header; a small file can still decode to hundreds of MB
+            if max(image.size) > app.config['AVATAR_MAX_DIMENSION']:
+                raise Image.DecompressionBombError(f"Image of {image.size[0]}x{image.size[1]} pixels is too large")
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            for size_name, size in AVATAR_SIZES.items():
+                path = os.path.join(folder, f"{name}-{size_name}.jpg")
+                if os.path.exists(path):
+                    continue
+                fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.jpg')
+                try:
+                    with os.fdopen(fd, 'wb') as out:
+                        ImageOps.fit(image, (size, size), Image.LANCZOS).save(out, 'JPEG', quality=85, optimize=True)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+        return name
+    finally:
+        os.remove(upload_path)
+
+def avatar_url(user, size):
+    # Pre-pipeline uploads and the default picture are still plain files in static/uploads
+    if '.' in user.image_file:
+        return url_for('static', filename='uploads/' + user.image_file)
+    return url_for('avatar', filename=f"{user.image_file}-{size}.jpg")
+
+app.jinja_env.globals['avatar_url'] = avatar_url
+
+# Password hashing runs on a small bounded pool, so a burst of logins queues up
+# behind PASSWORD_HASH_WORKERS threads instead of pinning every request worker.
+class PasswordHasher:
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+
+    def hash(self, password):
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+        return self.pool.submit(bcrypt.generate_password_hash, password, rounds).result().decode('utf-8')
+
+    def check(self, hashed, password):
+        return self.pool.submit(bcrypt.check_password_hash, hashed, password).result()
+
+    def needs_rehash(self, hashed):
+        # bcrypt hashes look like $2b$<cost>$<salt+digest>
+        return int(hashed.split('$')[2]) != app.config['BCRYPT_LOG_ROUNDS']
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'])
+
+@app.cli.command('calibrate-bcrypt')
+@click.option('--target-ms', default=250, help='Longest acceptable time for one hash.')
+def calibrate_bcrypt_command(target_ms):
+    """Find the highest bcrypt cost that hashes within the target time."""
+    chosen = 4
+    for rounds in range(4, 17):
+        start = time.perf_counter()
+        bcrypt.generate_password_hash('calibration', rounds)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"cost {rounds}: {elapsed:.0f} ms")
+        if elapsed > target_ms:
+            break
+        chosen = rounds
+    print(f"Set BCRYPT_LOG_ROUNDS = {chosen}")
+
+# Bulk import. Records come from .json (a list), .ndjson/.jsonl or .csv files and
+# are written with one executemany INSERT and one commit per batch.
+def read_records(path):
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, newline='', encoding='utf-8') as f:
+        if ext == '.csv':
+            yield from csv.DictReader(f)
+        elif ext in ('.ndjson', '.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif ext == '.json':
+            yield from json.load(f)
+        else:
+            raise click.BadParameter(f"unsupported file type '{ext}'", param_hint='PATH')
+
+def batched(records, size):
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+def run_import(label, records, batch_size, insert_batch):
+    start = time.perf_counter()
+    imported = 0
+    for batch in batched(records, batch_size):
+        imported += insert_batch(batch)
+        db.session.commit()
+        elapsed = time.perf_counter() - start
+        print(f"{label}: {imported} imported, {imported / elapsed:.0f} rows/s")
+    elapsed = time.perf_counter() - start
+    print(f"Done: {imported} {label} in {elapsed:.1f}s ({imported / max(elapsed, 1e-9):.0f} rows/s)")
+
+@app.cli.command('import-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Parallel bcrypt threads.')
+def import_users_command(path, batch_size, workers):
+    """Import users (username, email, password or password_hash); existing usernames/emails are skipped."""
+    rounds = app.config['BCRYPT_LOG_ROUNDS']
+
+    def hash_record(record):
+        if record.get('password_hash'):
+            return record['password_hash']
+        return bcrypt.generate_password_hash(record['password'], rounds).decode('utf-8')
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def insert_batch(batch):
+            hashes = pool.map(hash_record, batch)
+            rows = [{'username': record['username'], 'email': record['email'], 'password': hashed}
+                    for record, hashed in zip(batch, hashes)]
+            return db.session.connection().execute(insert(User.__table__).prefix_with('OR IGNORE'), rows).rowcount
+
+        run_import('users', read_records(path), batch_size, insert_batch)
+
+@app.cli.command('import-posts')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=1000, show_default=True)
+def import_posts_command(path, batch_size):
+    """Import posts (title, content, author username, optional date_posted)."""
+    def insert_batch(batch):
+        usernames = {record['author'] for record in batch}
+        user_ids = dict(db.session.execute(select(User.username, User.id).where(User.username.in_(usernames))).all())
+        now = datetime.utcnow()
+        rows = []
+        for record in batch:
+            if record['author'] not in user_ids:
+                print(f"Skipping post '{record['title']}': unknown author '{record['author']}'")
+                continue
+            date_posted = datetime.fromisoformat(record['date_posted']) if record.get('date_posted') else now
+            rows.append({'title': record['title'], 'content': record['content'],
+                         'excerpt': make_excerpt(record['content']), 'user_id': user_ids[record['author']],
+                         'date_posted': date_posted, 'updated_at': date_posted})
+        return insert_post_rows(rows)
+
+    run_import('posts', read_records(path), batch_size, insert_batch)
+
+def insert_post_rows(rows):
+    if not rows:
+        return 0
+    # Core inserts skip the mapper events, so index the new rows for search here
+    conn = db.session.connection()
+    ids = conn.execute(insert(Post.__table__).returning(Post.id, sort_by_parameter_order=True), rows).scalars().all()
+    conn.execute(text('INSERT INTO post_fts (rowid, title, content) VALUES (:id, :title, :content)'),
+                 [{'id': post_id, 'title': row['title'], 'content': row['content']} for post_id, row in zip(ids, rows)])
+    conn.execute(text('UPDATE user SET post_count = post_count + :added WHERE id = :id'),
+                 [{'id': user_id, 'added': added} for user_id, added in Counter(row['user_id'] for row in rows).items()])
+    return len(rows)
+
+# Page cache. A backend needs get(key), token(), set(key, value, ttl, tags, since), invalidate(*tags),
+# clear() and stats() returning {'entries', 'hits', 'misses'}; swap page_cache for a shared
+# implementation (e.g. Redis) to share entries across workers.
+# Callers take token() before reading the data a value is built from and pass it to set() as since;
+# if any of the value's tags was invalidated in between, the value may predate that write and is dropped.
+class MemoryCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.tag_keys = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sequence = 0  # bumped by every invalidate() and clear()
+        self.tag_sequence = {}  # tag -> sequence of its last invalidation
+        self.cleared = 0
+
+    def token(self):
+        with self.lock:
+            return self.sequence
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl, tags=(), since=None):
+        with self.lock:
+            if since is not None and (self.cleared > since
+                                      or any(self.tag_sequence.get(tag, 0) > since for tag in tags)):
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + ttl, value, tuple(tags))
+            for tag in tags:
+                self.tag_keys.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, *tags):
+        with self.lock:
+            self.sequence += 1
+            for tag in tags:
+                self.tag_sequence[tag] = self.sequence
+                for key in self.tag_keys.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.sequence += 1
+            self.cleared = self.sequence
+            self.tag_sequence.clear()
+            self.entries.clear()
+            self.tag_keys.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tag_keys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tag_keys[tag]
+
+page_cache = MemoryCache(app.config['PAGE_CACHE_SIZE'])
+
+# Login throttling. A backend needs consume(key, burst, per_minute) and wait(key, burst, per_minute),
+# both returning the seconds to wait (0 when allowed), where only consume spends a token, plus
+# clear(); swap login_limiter for a shared implementation (e.g. Redis) so workers draw from the
+# same buckets.
+class MemoryRateLimiter:
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> (tokens, monotonic time of last refill)
+        self.lock = threading.Lock()
+
+    def consume(self, key, burst, per_minute):
+        return self._take(key, burst, per_minute, 1)
+
+    def wait(self, key, burst, per_minute):
+        return self._take(key, burst, per_minute, 0)
+
+    def _take(self, key, burst, per_minute, cost):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * per_minute / 60)
+            wait = 0 if tokens >= 1 else (1 - tokens) * 60 / per_minute
+            self.buckets[key] = (tokens - cost if not wait else tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+login_limiter = MemoryRateLimiter(app.config['RATE_LIMIT_KEYS'])
+
+def login_throttle(email):
+    """Seconds the client must wait before another login attempt, checked before any hashing or queries."""
+    if not app.config['LOGIN_RATE_LIMIT']:
+        return 0
+    # One IP cannot spray accounts and many IPs cannot hammer one account. The account bucket is
+    # only checked here and spent by login_failed, so neither an attempt the IP bucket refused nor
+    # a correct password drains it and locks the owner out.
+    # remote_addr is the client's address once TRUSTED_PROXIES matches the proxies in front of the app.
+    ip_wait = login_limiter.consume(f"ip:{request.remote_addr}", app.config['LOGIN_IP_BURST'],
+                                    app.config['LOGIN_IP_PER_MINUTE'])
+    if ip_wait:
+        return ip_wait
+    return login_limiter.wait(f"account:{email.strip().lower()}", app.config['LOGIN_ACCOUNT_BURST'],
+                              app.config['LOGIN_ACCOUNT_PER_MINUTE'])
+
+def login_failed(email):
+    if app.config['LOGIN_RATE_LIMIT']:
+        login_limiter.consume(f"account:{email.strip().lower()}", app.config['LOGIN_ACCOUNT_BURST'],
+                              app.config['LOGIN_ACCOUNT_PER_MINUTE'])
+
+# Logged-in users are rebuilt from cached column values and merged into the
+# session without a SELECT; account() invalidates the entry when it changes them.
+user_cache = MemoryCache(app.config['USER_CACHE_SIZE'])
+# post_count changes with every post, so it is left unloaded and read from the database on use
+USER_CACHED_FIELDS = [column.key for column in User.__table__.columns if column.key not in ('password', 'post_count')]
+
+@login_manager.user_loader
+def load_user(user_id):
+    fields = user_cache.get(int(user_id))
+    if fields is None:
+        # An account() commit between this read and set() leaves the token stale, so the row isn't cached
+        since = user_cache.token()
+        user = db.session.get(User, int(user_id))
+        if user is not None:
+            fields = {key: getattr(user, key) for key in USER_CACHED_FIELDS}
+            user_cache.set(user.id, fields, app.config['USER_CACHE_TTL'], [f"user:{user.id}"], since)
+        return user
+    user = User(**fields)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def cache_tags(*tags):
+    # Views declare what their output depends on; writes invalidate by the same tags
+    if 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+# Used from templates as {% call cached_fragment(name, *tags) %}...{% endcall %}
+def cached_fragment(name, *tags, caller):
+    if not app.config['PAGE_CACHE_ENABLED']:
+        return Markup(caller())
+    key = f"fragment|{name}"
+    html = page_cache.get(key)
+    if html is None:
+        since = page_cache.token()
+        html = str(caller())
+        page_cache.set(key, html, app.config['PAGE_CACHE_TTL'], tags, since)
+    return Markup(html)
+
+app.jinja_env.globals['cached_fragment'] = cached_fragment
+
+def external_url(endpoint, **values):
+    if app.config['SITE_URL']:
+        return app.config['SITE_URL'].rstrip('/') + url_for(endpoint, **values)
+    return url_for(endpoint, _external=True, **values)
+
+app.jinja_env.globals['external_url'] = external_url
+
+def cached_xml(key, tags, render, mimetype):
+    # Feeds and sitemaps look the same to every visitor and only change on post writes. Without
+    # SITE_URL their links come from the Host header, so one forged Host must not poison other hosts' copy.
+    if not app.config['PAGE_CACHE_ENABLED']:
+        return Response(render(), mimetype=mimetype)
+    if not app.config['SITE_URL']:
+        key = f"{key}|{request.host_url}"
+    xml = page_cache.get(key)
+    if xml is None:
+        since = page_cache.token()
+        xml = render()
+        page_cache.set(key, xml, app.config['FEED_CACHE_TTL'], tags, since)
+    return Response(xml, mimetype=mimetype)
+
+def cached_page(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Pages carrying flash messages are one-off and must not be cached
+        if request.method != 'GET' or session.get('_flashes') or not app.config['PAGE_CACHE_ENABLED']:
+            return view(*args, **kwargs)
+        auth = f"user:{current_user.id}" if current_user.is_authenticated else 'anon'
+        key = f"page|{request.endpoint}|{request.full_path}|{auth}"
+        cached = page_cache.get(key)
+        if cached is not None:
+            html, etag, last_modified = cached
+            return with_validators(html, etag, last_modified).make_conditional(request)
+        g.cache_tags = set()
+        since = page_cache.token()
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and response.mimetype == 'text/html':
+            cached = (response.get_data(as_text=True), response.get_etag()[0], response.last_modified)
+            page_cache.set(key, cached, app.config['PAGE_CACHE_TTL'], g.cache_tags, since)
+        return response
+    return wrapper
+
+# Conditional GET. Validators come from rows the view has already loaded, so a
+# matching If-None-Match / If-Modified-Since is answered before any rendering.
+def page_validators(posts, *extra):
+    viewer = current_user.id if current_user.is_authenticated else 'anon'
+    parts = [str(viewer)] + [str(value) for value in extra]
+    for post in posts:
+        parts.append(f"{post.id}:{post.updated_at.isoformat()}:{post.author.username}:{post.author.image_file}")
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+def render_conditional(template_name, etag, last_modified=None, **context):
+    if not session.get('_flashes') and \
+            not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return with_validators('', etag, last_modified, status=304)
+    return with_validators(render_template(template_name, **context), etag, last_modified)
+
+def with_validators(body, etag, last_modified=None, status=200):
+    response = make_response(body, status)
+    # Weak, so the same validator still matches once the body is gzip-encoded
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+def posts_changed(user_id, post_id=None):
+    forget_post_totals()
+    tags = ['posts', f"user:{user_id}"]
+    if post_id is not None:
+        tags.append(f"post:{post_id}")
+    page_cache.invalidate(*tags)
+
 # HTML Templates
+blog_css = '''
+.navbar-brand { font-weight: bold; }
+.article-content { white-space: pre-line; }
+.post-img { max-height: 300px; object-fit: cover; }
+.account-img { width: 125px; height: 125px; object-fit: cover; }
+'''
+
 base_template = '''
 <!DOCTYPE html>
 <html lang="en">
@@ -56,14 +829,14 @@ base_template = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>{% block title %}Blog{% endblock %}</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet">
-    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.1/font/bootstrap-icons.css">
-    <style>
-        .navbar-brand { font-weight: bold; }
-        .article-content { white-space: pre-line; }
-        .post-img { max-height: 300px; object-fit: cover; }
-        .account-img { width: 125px; height: 125px; object-fit: cover; }
-    </style>
+    <link rel="alternate" type="application/atom+xml" title="FlaskBlog" href="{{ url_for('feed') }}">
+    <link href="{{ asset_url('bootstrap.min.css') }}" rel="stylesheet">
+    <link rel="stylesheet" href="{{ asset_url('bootstrap-icons.css') }}">
+    {% if asset_url('blog.css') %}
+        <link rel="stylesheet" href="{{ asset_url('blog.css') }}">
+    {% else %}
+        <style>{{ blog_css }}</style>
+    {% endif %}
 </head>
 <body>
     <nav class="navbar navbar-expand-lg navbar-dark bg-primary">
@@ -81,6 +854,9 @@ base_template = '''
                         <a class="nav-link" href="{{ url_for('about') }}">About</a>
                     </li>
                 </ul>
+                <form class="d-flex me-3" method="GET" action="{{ url_for('search') }}">
+                    <input class="form-control form-control-sm" type="search" name="q" placeholder="Search">
+                </form>
                 <ul class="navbar-nav">
                     {% if current_user.is_authenticated %}
                         <li class="nav-item">
@@ -138,7 +914,7 @@ base_template = '''
         </div>
     </div>
 
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
+    <script src="{{ asset_url('bootstrap.bundle.min.js') }}"></script>
 </body>
 </html>
 '''
@@ -147,30 +923,41 @@ home_template = '''
 {% extends "base.html" %}
 {% block content %}
     {% for post in posts.items %}
-        <article class="media content-section mb-4">
-            <img class="rounded-circle article-img me-3" src="{{ url_for('static', filename='uploads/' + post.author.image_file) }}">
-            <div class="media-body">
-                <div class="article-metadata">
-                    <a class="me-2" href="{{ url_for('user_posts', username=post.author.username) }}">{{ post.author.username }}</a>
-                    <small class="text-muted">{{ post.date_posted.strftime('%Y-%m-%d') }}</small>
+        {% call cached_fragment('post-summary-' ~ post.id, 'post:' ~ post.id, 'user:' ~ post.user_id) %}
+            <article class="media content-section mb-4">
+                <img class="rounded-circle article-img me-3" width="64" height="64" src="{{ avatar_url(post.author, 'list') }}">
+                <div class="media-body">
+                    <div class="article-metadata">
+                        <a class="me-2" href="{{ url_for('user_posts', username=post.author.username) }}">{{ post.author.username }}</a>
+                        <small class="text-muted">{{ post.date_posted.strftime('%Y-%m-%d') }}</small>
+                    </div>
+                    <h2><a class="article-title text-decoration-none" href="{{ url_for('post', post_id=post.id) }}">{{ post.title }}</a></h2>
+                    <p class="article-content">{{ post.excerpt }}...</p>
                 </div>
-                <h2><a class="article-title text-decoration-none" href="{{ url_for('post', post_id=post.id) }}">{{ post.title }}</a></h2>
-                <p class="article-content">{{ post.content[:200] }}...</p>
-            </div>
-        </article>
+            </article>
+        {% endcall %}
     {% endfor %}
     
-    {% for page_num in posts.iter_pages(left_edge=1, right_edge=1, left_current=1, right_current=2) %}
-        {% if page_num %}
-            {% if posts.page == page_num %}
-                <a class="btn btn-primary mb-4" href="{{ url_for('home', page=page_num) }}">{{ page_num }}</a>
+    {% if config.PAGINATION_MODE == 'numbered' %}
+        {% for page_num in posts.iter_pages(left_edge=1, right_edge=1, left_current=1, right_current=2) %}
+            {% if page_num %}
+                {% if posts.page == page_num %}
+                    <a class="btn btn-primary mb-4" href="{{ url_for('home', page=page_num) }}">{{ page_num }}</a>
+                {% else %}
+                    <a class="btn btn-outline-primary mb-4" href="{{ url_for('home', page=page_num) }}">{{ page_num }}</a>
+                {% endif %}
             {% else %}
-                <a class="btn btn-outline-primary mb-4" href="{{ url_for('home', page=page_num) }}">{{ page_num }}</a>
+                ...
             {% endif %}
-        {% else %}
-            ...
+        {% endfor %}
+    {% else %}
+        {% if posts.prev_cursor %}
+            <a class="btn btn-outline-primary mb-4" href="{{ url_for('home', before=posts.prev_cursor) }}">Newer Posts</a>
         {% endif %}
-    {% endfor %}
+        {% if posts.next_cursor %}
+            <a class="btn btn-outline-primary mb-4" href="{{ url_for('home', after=posts.next_cursor) }}">Older Posts</a>
+        {% endif %}
+    {% endif %}
 {% endblock %}
 '''
 
@@ -178,7 +965,7 @@ post_template = '''
 {% extends "base.html" %}
 {% block content %}
     <article class="media content-section">
-        <img class="rounded-circle article-img me-3" src="{{ url_for('static', filename='uploads/' + post.author.image_file) }}">
+        <img class="rounded-circle article-img me-3" width="64" height="64" src="{{ avatar_url(post.author, 'list') }}">
         <div class="media-body">
             <div class="article-metadata">
                 <a class="me-2" href="{{ url_for('user_posts', username=post.author.username) }}">{{ post.author.username }}</a>
@@ -191,7 +978,11 @@ post_template = '''
                 {% endif %}
             </div>
             <h2 class="article-title">{{ post.title }}</h2>
-            <p class="article-content">{{ post.content }}</p>
+            {% if post.render_version %}
+                <div class="article-body">{{ post.body_html|safe }}</div>
+            {% else %}
+                <p class="article-content">{{ post.content }}</p>
+            {% endif %}
         </div>
     </article>
 
@@ -316,7 +1107,7 @@ account_template = '''
 {% block content %}
     <div class="content-section">
         <div class="media">
-            <img class="rounded-circle account-img" src="{{ url_for('static', filename='uploads/' + current_user.image_file) }}">
+            <img class="rounded-circle account-img" src="{{ avatar_url(current_user, 'profile') }}">
             <div class="media-body">
                 <h2 class="account-heading">{{ current_user.username }}</h2>
                 <p class="text-secondary">{{ current_user.email }}</p>
@@ -357,51 +1148,348 @@ about_template = '''
 user_posts_template = '''
 {% extends "base.html" %}
 {% block content %}
-    <h1 class="mb-3">Posts by {{ user.username }} ({{ posts.total }})</h1>
+    <h1 class="mb-3">Posts by {{ user.username }} ({{ user.post_count }})</h1>
     {% for post in posts.items %}
+        {% call cached_fragment('post-summary-' ~ post.id, 'post:' ~ post.id, 'user:' ~ post.user_id) %}
+            <article class="media content-section mb-4">
+                <img class="rounded-circle article-img me-3" width="64" height="64" src="{{ avatar_url(post.author, 'list') }}">
+                <div class="media-body">
+                    <div class="article-metadata">
+                        <a class="me-2" href="{{ url_for('user_posts', username=post.author.username) }}">{{ post.author.username }}</a>
+                        <small class="text-muted">{{ post.date_posted.strftime('%Y-%m-%d') }}</small>
+                    </div>
+                    <h2><a class="article-title text-decoration-none" href="{{ url_for('post', post_id=post.id) }}">{{ post.title }}</a></h2>
+                    <p class="article-content">{{ post.excerpt }}...</p>
+                </div>
+            </article>
+        {% endcall %}
+    {% endfor %}
+    
+    {% if config.PAGINATION_MODE == 'numbered' %}
+        {% for page_num in posts.iter_pages(left_edge=1, right_edge=1, left_current=1, right_current=2) %}
+            {% if page_num %}
+                {% if posts.page == page_num %}
+                    <a class="btn btn-primary mb-4" href="{{ url_for('user_posts', username=user.username, page=page_num) }}">{{ page_num }}</a>
+                {% else %}
+                    <a class="btn btn-outline-primary mb-4" href="{{ url_for('user_posts', username=user.username, page=page_num) }}">{{ page_num }}</a>
+                {% endif %}
+            {% else %}
+                ...
+            {% endif %}
+        {% endfor %}
+    {% else %}
+        {% if posts.prev_cursor %}
+            <a class="btn btn-outline-primary mb-4" href="{{ url_for('user_posts', username=user.username, before=posts.prev_cursor) }}">Newer Posts</a>
+        {% endif %}
+        {% if posts.next_cursor %}
+            <a class="btn btn-outline-primary mb-4" href="{{ url_for('user_posts', username=user.username, after=posts.next_cursor) }}">Older Posts</a>
+        {% endif %}
+    {% endif %}
+{% endblock %}
+'''
+
+search_template = '''
+{% extends "base.html" %}
+{% block content %}
+    <form class="mb-4" method="GET" action="{{ url_for('search') }}">
+        <div class="input-group">
+            <input type="search" class="form-control" name="q" value="{{ q }}" placeholder="Search posts">
+            <button type="submit" class="btn btn-primary">Search</button>
+        </div>
+    </form>
+    {% for post, snippet in results %}
         <article class="media content-section mb-4">
-            <img class="rounded-circle article-img me-3" src="{{ url_for('static', filename='uploads/' + post.author.image_file) }}">
             <div class="media-body">
                 <div class="article-metadata">
                     <a class="me-2" href="{{ url_for('user_posts', username=post.author.username) }}">{{ post.author.username }}</a>
                     <small class="text-muted">{{ post.date_posted.strftime('%Y-%m-%d') }}</small>
                 </div>
                 <h2><a class="article-title text-decoration-none" href="{{ url_for('post', post_id=post.id) }}">{{ post.title }}</a></h2>
-                <p class="article-content">{{ post.content[:200] }}...</p>
+                <p class="article-content">{{ snippet }}</p>
             </div>
         </article>
+    {% else %}
+        {% if q %}<p>No posts match "{{ q }}".</p>{% endif %}
     {% endfor %}
-    
-    {% for page_num in posts.iter_pages(left_edge=1, right_edge=1, left_current=1, right_current=2) %}
-        {% if page_num %}
-            {% if posts.page == page_num %}
-                <a class="btn btn-primary mb-4" href="{{ url_for('user_posts', username=user.username, page=page_num) }}">{{ page_num }}</a>
-            {% else %}
-                <a class="btn btn-outline-primary mb-4" href="{{ url_for('user_posts', username=user.username, page=page_num) }}">{{ page_num }}</a>
-            {% endif %}
+    {% if next_cursor %}
+        <a class="btn btn-outline-primary mb-4" href="{{ url_for('search', q=q, after=next_cursor) }}">More Results</a>
+    {% endif %}
+{% endblock %}
+'''
+
+feed_template = '''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+    <title>{{ title }}</title>
+    <id>{{ feed_url }}</id>
+    <link rel="self" href="{{ feed_url }}"/>
+    <link href="{{ site_url }}"/>
+    <updated>{{ updated.strftime('%Y-%m-%dT%H:%M:%SZ') }}</updated>
+    {% for post in posts %}
+    <entry>
+        <title>{{ post.title }}</title>
+        <id>{{ external_url('post', post_id=post.id) }}</id>
+        <link href="{{ external_url('post', post_id=post.id) }}"/>
+        <author><name>{{ post.author.username }}</name></author>
+        <published>{{ post.date_posted.strftime('%Y-%m-%dT%H:%M:%SZ') }}</published>
+        <updated>{{ post.updated_at.strftime('%Y-%m-%dT%H:%M:%SZ') }}</updated>
+        {% if post.render_version %}
+        <content type="html">{{ post.body_html }}</content>
         {% else %}
-            ...
+        <summary>{{ post.excerpt }}</summary>
         {% endif %}
+    </entry>
     {% endfor %}
-{% endblock %}
+</feed>
 '''
 
-# Custom render function to use our string templates
-def render_template_string(template_string, **context):
-    from flask import render_template_string as flask_render_template_string
-    return flask_render_template_string(template_string, **context)
+sitemap_template = '''<?xml version="1.0" encoding="utf-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+    {% for url, lastmod in urls %}
+    <url>
+        <loc>{{ url }}</loc>
+        {% if lastmod %}<lastmod>{{ lastmod.strftime('%Y-%m-%d') }}</lastmod>{% endif %}
+    </url>
+    {% endfor %}
+</urlset>
+'''
+
+sitemap_index_template = '''<?xml version="1.0" encoding="utf-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+    {% for number in range(1, pages + 1) %}
+    <sitemap><loc>{{ external_url('sitemap_page', number=number) }}</loc></sitemap>
+    {% endfor %}
+</sitemapindex>
+'''
+
+# Register the string templates once so Jinja compiles and caches them by name
+templates = {
+    'base.html': base_template,
+    'home.html': home_template,
+    'post.html': post_template,
+    'create_post.html': create_post_template,
+    'login.html': login_template,
+    'register.html': register_template,
+    'account.html': account_template,
+    'about.html': about_template,
+    'user_posts.html': user_posts_template,
+    'search.html': search_template,
+    'feed.xml': feed_template,
+    'sitemap.xml': sitemap_template,
+    'sitemap_index.xml': sitemap_index_template,
+}
+app.jinja_env.loader = ChoiceLoader([DictLoader(templates), app.jinja_env.loader])
+for template_name in templates:
+    app.jinja_env.get_template(template_name)
+
+# Instrumentation. Every request records latency, SQL query count and time,
+# template render time and response size per endpoint; /metrics exposes them
+# in Prometheus text format.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.queries = {}
+        self.totals = {}
+
+    def observe(self, endpoint, method, status, seconds, queries, sql_seconds, render_seconds, size):
+        with self.lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.queries.setdefault(endpoint, Histogram(QUERY_COUNT_BUCKETS)).observe(queries)
+            totals = self.totals.setdefault(endpoint, {'sql_seconds': 0, 'render_seconds': 0, 'response_bytes': 0})
+            totals['sql_seconds'] += sql_seconds
+            totals['render_seconds'] += render_seconds
+            totals['response_bytes'] += size
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines += ['# HELP blog_requests_total Requests handled.', '# TYPE blog_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'blog_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+            for name, help_text, histograms in (
+                    ('blog_request_duration_seconds', 'Request latency.', self.latency),
+                    ('blog_request_sql_queries', 'SQL queries per request.', self.queries)):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for endpoint, histogram in sorted(histograms.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{endpoint="{endpoint}"}} {histogram.count}')
+            for total, help_text in (('sql_seconds', 'Time spent in SQL.'),
+                                     ('render_seconds', 'Time spent rendering templates.'),
+                                     ('response_bytes', 'Response body bytes sent.')):
+                lines += [f'# HELP blog_{total}_total {help_text}', f'# TYPE blog_{total}_total counter']
+                for endpoint, totals in sorted(self.totals.items()):
+                    lines.append(f'blog_{total}_total{{endpoint="{endpoint}"}} {totals[total]}')
+        lines += ['# HELP blog_cache_lookups_total Cache lookups by result.', '# TYPE blog_cache_lookups_total counter']
+        for name, cache in (('pages', page_cache), ('users', user_cache)):
+            stats = cache.stats()
+            lines.append(f'blog_cache_lookups_total{{cache="{name}",result="hit"}} {stats["hits"]}')
+            lines.append(f'blog_cache_lookups_total{{cache="{name}",result="miss"}} {stats["misses"]}')
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+        if app.config['SLOW_REQUEST_MS'] and len(g.sql_log) < 50:
+            g.sql_log.append((elapsed, statement))
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def record_render(sender, template, context, **extra):
+    if 'render_start' in g:
+        g.render_seconds = g.get('render_seconds', 0) + time.perf_counter() - g.pop('render_start')
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0
+    g.sql_log = []
+
+@app.after_request
+def record_request(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unmatched'
+    size = 0 if response.is_streamed else response.calculate_content_length() or 0
+    request_metrics.observe(endpoint, request.method, response.status_code, elapsed,
+                            g.sql_queries, g.sql_seconds, g.get('render_seconds', 0), size)
+    slow_ms = app.config['SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        queries = '\n'.join(f"  {seconds * 1000:.1f} ms  {statement}"
+                            for seconds, statement in sorted(g.sql_log, reverse=True))
+        app.logger.warning("Slow request %s %s: %.0f ms, %d queries (%.0f ms SQL)\n%s", request.method,
+                           request.full_path, elapsed * 1000, g.sql_queries, g.sql_seconds * 1000, queries)
+    return response
+
+# Static assets. `flask build-assets` vendors the CDN files and blog_css into
+# static/assets under content-hashed names, with .gz/.br siblings, and writes a
+# manifest. Until it has been run, pages fall back to the CDN and an inline <style>.
+ASSET_SOURCES = {
+    'bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css',
+    'bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js',
+    'bootstrap-icons.woff2': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.1/font/fonts/bootstrap-icons.woff2',
+    'bootstrap-icons.woff': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.1/font/fonts/bootstrap-icons.woff',
+    'bootstrap-icons.css': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.1/font/bootstrap-icons.css',
+}
+COMPRESSIBLE_ASSETS = ('.css', '.js')
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(app.config['ASSET_FOLDER'], 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+asset_manifest = load_asset_manifest()
+
+def asset_url(name):
+    if name in asset_manifest:
+        return url_for('asset', filename=asset_manifest[name])
+    return ASSET_SOURCES.get(name)
+
+app.jinja_env.globals['asset_url'] = asset_url
+app.jinja_env.globals['blog_css'] = Markup(blog_css)
+
+def write_asset(name, data):
+    stem, ext = os.path.splitext(name)
+    filename = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+    path = os.path.join(app.config['ASSET_FOLDER'], filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if ext in COMPRESSIBLE_ASSETS:
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data, quality=11))
+    return filename
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Download, fingerprint and precompress the site's CSS, JS and fonts."""
+    os.makedirs(app.config['ASSET_FOLDER'], exist_ok=True)
+    if brotli is None:
+        print("brotli is not installed; writing gzip variants only")
+    manifest = {}
+    for name, source in ASSET_SOURCES.items():
+        with urllib.request.urlopen(source) as response:
+            data = response.read()
+        if name == 'bootstrap-icons.css':
+            # Point the font URLs at the fingerprinted copies built above
+            data = re.sub(rb'url\("?\./fonts/([^?")]+)[^)]*\)',
+                          lambda m: b'url("' + manifest[m.group(1).decode()].encode() + b'")', data)
+        manifest[name] = write_asset(name, data)
+        print(f"{name} -> {manifest[name]}")
+    manifest['blog.css'] = write_asset('blog.css', blog_css.encode())
+    with open(os.path.join(app.config['ASSET_FOLDER'], 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    asset_manifest.clear()
+    asset_manifest.update(manifest)
+
+@app.after_request
+def compress_response(response):
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers \
+            or response.mimetype not in ('text/html', 'application/json', 'application/atom+xml', 'application/xml') \
+            or not request.accept_encodings['gzip']:
+        return response
+    data = response.get_data()
+    if len(data) < app.config['GZIP_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
 
 # Routes
 @app.route("/")
 @app.route("/home")
+@cached_page
 def home():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.date_posted.desc()).paginate(page=page, per_page=5)
-    return render_template_string(home_template, posts=posts)
+    cache_tags('posts')
+    posts = paginate_posts(listing_query(), lambda: cached_post_total('all', Post.query))
+    etag = page_validators(posts.items, getattr(posts, 'next_cursor', None),
+                           getattr(posts, 'prev_cursor', None), getattr(posts, 'total', None))
+    return render_conditional('home.html', etag, posts=posts)
 
 @app.route("/about")
 def about():
-    return render_template_string(about_template, title='About')
+    return render_template('about.html', title='About')
 
 @app.route("/register", methods=['GET', 'POST'])
 def register():
@@ -418,7 +1506,7 @@ def register():
             flash('Passwords do not match', 'danger')
             return redirect(url_for('register'))
         
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+        hashed_password = password_hasher.hash(password)
         user = User(username=username, email=email, password=hashed_password)
         
         try:
@@ -429,7 +1517,7 @@ def register():
         except:
             flash('Username or email already exists', 'danger')
     
-    return render_template_string(register_template, title='Register')
+    return render_template('register.html', title='Register')
 
 @app.route("/login", methods=['GET', 'POST'])
 def login():
@@ -439,17 +1527,27 @@ def login():
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
+        wait = login_throttle(email or '')
+        if wait:
+            flash(f"Too many login attempts. Please try again in {int(wait) + 1} seconds.", 'danger')
+            response = make_response(render_template('login.html', title='Login'), 429)
+            response.headers['Retry-After'] = str(int(wait) + 1)
+            return response
         user = User.query.filter_by(email=email).first()
         
-        if user and bcrypt.check_password_hash(user.password, password):
+        if user and password_hasher.check(user.password, password):
+            if password_hasher.needs_rehash(user.password):
+                user.password = password_hasher.hash(password)
+                db.session.commit()
             login_user(user)
             next_page = request.args.get('next')
             flash('You have been logged in!', 'success')
             return redirect(next_page) if next_page else redirect(url_for('home'))
         else:
+            login_failed(email or '')
             flash('Login unsuccessful. Please check email and password', 'danger')
     
-    return render_template_string(login_template, title='Login')
+    return render_template('login.html', title='Login')
 
 @app.route("/logout")
 def logout():
@@ -460,16 +1558,6 @@ def logout():
 @login_required
 def account():
     if request.method == 'POST':
-        if 'picture' in request.files:
-            file = request.files['picture']
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file_ext = filename.rsplit('.', 1)[1].lower()
-                filename = f"{current_user.username}_profile.{file_ext}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
-                current_user.image_file = filename
-                
         username = request.form.get('username')
         email = request.form.get('email')
         
@@ -487,11 +1575,27 @@ def account():
                 return redirect(url_for('account'))
             current_user.email = email
         
+        # Process the picture only once the form is valid, so a rejected form leaves no thumbnails behind
+        if 'picture' in request.files:
+            file = request.files['picture']
+            if file and allowed_file(file.filename):
+                try:
+                    current_user.image_file = save_avatar(file)
+                except Image.DecompressionBombError:
+                    flash(f"Images can be at most {app.config['AVATAR_MAX_DIMENSION']} pixels wide and tall", 'danger')
+                    return redirect(url_for('account'))
+                except (UnidentifiedImageError, OSError):
+                    flash('That file is not a readable image', 'danger')
+                    return redirect(url_for('account'))
+        
         db.session.commit()
+        # Username and avatar appear on every listing and on the user's post pages
+        page_cache.invalidate('posts', f"user:{current_user.id}")
+        user_cache.invalidate(f"user:{current_user.id}")
         flash('Your account has been updated!', 'success')
         return redirect(url_for('account'))
     
-    return render_template_string(account_template, title='Account')
+    return render_template('account.html', title='Account')
 
 @app.route("/post/new", methods=['GET', 'POST'])
 @login_required
@@ -499,17 +1603,23 @@ def new_post():
     if request.method == 'POST':
         title = request.form.get('title')
         content = request.form.get('content')
-        post = Post(title=title, content=content, author=current_user)
+        post = Post(title=title, author=current_user)
+        set_post_content(post, content)
         db.session.add(post)
+        change_post_count(current_user.id, 1)
         db.session.commit()
+        posts_changed(current_user.id, post.id)
         flash('Your post has been created!', 'success')
         return redirect(url_for('home'))
-    return render_template_string(create_post_template, title='New Post')
+    return render_template('create_post.html', title='New Post')
 
 @app.route("/post/<int:post_id>")
+@cached_page
 def post(post_id):
-    post = Post.query.get_or_404(post_id)
-    return render_template_string(post_template, title=post.title, post=post)
+    post = post_query().filter(Post.id == post_id).first_or_404()
+    cache_tags(f"post:{post.id}", f"user:{post.user_id}")
+    etag = page_validators([post])
+    return render_conditional('post.html', etag, post.updated_at, title=post.title, post=post)
 
 @app.route("/post/<int:post_id>/update", methods=['GET', 'POST'])
 @login_required
@@ -520,12 +1630,13 @@ def update_post(post_id):
     
     if request.method == 'POST':
         post.title = request.form.get('title')
-        post.content = request.form.get('content')
+        set_post_content(post, request.form.get('content'))
         db.session.commit()
+        posts_changed(current_user.id, post.id)
         flash('Your post has been updated!', 'success')
         return redirect(url_for('post', post_id=post.id))
     
-    return render_template_string(create_post_template, title='Update Post', post=post)
+    return render_template('create_post.html', title='Update Post', post=post)
 
 @app.route("/post/<int:post_id>/delete", methods=['POST'])
 @login_required
@@ -534,22 +1645,364 @@ def delete_post(post_id):
     if post.author != current_user:
         abort(403)
     db.session.delete(post)
+    change_post_count(current_user.id, -1)
     db.session.commit()
+    posts_changed(current_user.id, post_id)
     flash('Your post has been deleted!', 'success')
     return redirect(url_for('home'))
 
 @app.route("/user/<string:username>")
+@cached_page
 def user_posts(username):
-    page = request.args.get('page', 1, type=int)
     user = User.query.filter_by(username=username).first_or_404()
-    posts = Post.query.filter_by(author=user)\
-        .order_by(Post.date_posted.desc())\
-        .paginate(page=page, per_page=5)
-    return render_template_string(user_posts_template, posts=posts, user=user)
+    cache_tags(f"user:{user.id}")
+    query = listing_query().filter(Post.user_id == user.id)
+    posts = paginate_posts(query, lambda: user.post_count)
+    etag = page_validators(posts.items, user.username, user.post_count, getattr(posts, 'next_cursor', None),
+                           getattr(posts, 'prev_cursor', None))
+    return render_conditional('user_posts.html', etag, posts=posts, user=user)
+
+@app.route("/search")
+def search():
+    q = request.args.get('q', '').strip()
+    results, next_cursor = search_posts(q, after=request.args.get('after'))
+    return render_template('search.html', title='Search', q=q, results=results, next_cursor=next_cursor)
+
+@app.route("/api/search")
+def api_search():
+    q = request.args.get('q', '').strip()
+    results, next_cursor = search_posts(q, after=request.args.get('after'))
+    return jsonify({
+        'results': [dict(post_json(post), snippet=str(snippet)) for post, snippet in results],
+        'next_cursor': next_cursor,
+    })
+
+# Read API
+def post_json(post):
+    return {
+        'id': post.id,
+        'title': post.title,
+        'excerpt': post.excerpt,
+        'author': post.author.username,
+        'date_posted': post.date_posted.isoformat(),
+        'updated_at': post.updated_at.isoformat(),
+        'url': url_for('post', post_id=post.id, _external=True),
+    }
+
+def api_post_page(query):
+    per_page = min(request.args.get('limit', app.config['POSTS_PER_PAGE'], type=int), app.config['API_MAX_PER_PAGE'])
+    posts = paginate_keyset(query, after=request.args.get('after'), before=request.args.get('before'),
+                            per_page=max(per_page, 1))
+    return jsonify({
+        'posts': [post_json(post) for post in posts.items],
+        'next_cursor': posts.next_cursor,
+        'prev_cursor': posts.prev_cursor,
+    })
+
+@app.route("/api/posts")
+def api_posts():
+    return api_post_page(listing_query())
+
+@app.route("/api/users/<string:username>/posts")
+def api_user_posts(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return api_post_page(listing_query().filter(Post.user_id == user.id))
+
+@app.route("/api/posts/export.ndjson")
+def api_export_posts():
+    # Rows are streamed from a server-side cursor in EXPORT_BATCH_SIZE chunks, so
+    # memory stays flat however large the post table is
+    statement = select(Post.id, Post.title, Post.content, Post.date_posted, Post.updated_at, User.username)\
+        .join(User, Post.user_id == User.id).order_by(Post.id)
+    engine = db.engine
+
+    def generate():
+        with engine.connect() as conn:
+            result = conn.execution_options(yield_per=app.config['EXPORT_BATCH_SIZE']).execute(statement)
+            for row in result:
+                yield json.dumps({
+                    'id': row.id,
+                    'title': row.title,
+                    'content': row.content,
+                    'author': row.username,
+                    'date_posted': row.date_posted.isoformat(),
+                    'updated_at': row.updated_at.isoformat(),
+                }) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Feeds and sitemaps
+def render_feed(title, feed_url, site_url, query):
+    posts = query.order_by(Post.date_posted.desc(), Post.id.desc()).limit(app.config['FEED_SIZE']).all()
+    updated = max((post.updated_at for post in posts), default=datetime.utcnow())
+    return render_template('feed.xml', title=title, feed_url=feed_url, site_url=site_url, posts=posts,
+                           updated=updated)
+
+@app.route("/feed.xml")
+def feed():
+    return cached_xml('feed|all', ['posts'], lambda: render_feed(
+        'FlaskBlog', external_url('feed'), external_url('home'), post_query()), 'application/atom+xml')
+
+@app.route("/user/<string:username>/feed.xml")
+def user_feed(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return cached_xml(f"feed|user:{user.id}", [f"user:{user.id}"], lambda: render_feed(
+        f"Posts by {user.username}", external_url('user_feed', username=user.username),
+        external_url('user_posts', username=user.username),
+        post_query().filter(Post.user_id == user.id)), 'application/atom+xml')
+
+def sitemap_post_urls(number):
+    # Sitemap files cover fixed primary-key ranges, so any one of them is a single index range scan
+    size = app.config['SITEMAP_MAX_URLS']
+    rows = db.session.execute(select(Post.id, Post.updated_at)
+                              .where(Post.id > (number - 1) * size, Post.id <= number * size)
+                              .order_by(Post.id)).all()
+    return [(external_url('post', post_id=row.id), row.updated_at) for row in rows]
+
+def sitemap_pages():
+    max_id = db.session.scalar(select(db.func.max(Post.id))) or 0
+    return max(1, -(-max_id // app.config['SITEMAP_MAX_URLS']))
+
+@app.route("/sitemap.xml")
+def sitemap():
+    def render():
+        pages = sitemap_pages()
+        if pages > 1:
+            return render_template('sitemap_index.xml', pages=pages)
+        urls = [(external_url('home'), None), (external_url('about'), None)]
+        return render_template('sitemap.xml', urls=urls + sitemap_post_urls(1))
+    return cached_xml('sitemap|index', ['posts'], render, 'application/xml')
+
+@app.route("/sitemap-<int:number>.xml")
+def sitemap_page(number):
+    if not 1 <= number <= sitemap_pages():
+        abort(404)
+    def render():
+        urls = [(external_url('home'), None), (external_url('about'), None)] if number == 1 else []
+        return render_template('sitemap.xml', urls=urls + sitemap_post_urls(number))
+    return cached_xml(f"sitemap|{number}", ['posts'], render, 'application/xml')
+
+@app.route("/avatar/<path:filename>")
+def avatar(filename):
+    response = send_from_directory(app.config['AVATAR_FOLDER'], filename, max_age=app.config['AVATAR_MAX_AGE'])
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/assets/<path:filename>")
+def asset(filename):
+    # Serve the best precompressed variant the client accepts
+    encodings = request.accept_encodings
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encodings[encoding] and os.path.exists(os.path.join(app.config['ASSET_FOLDER'], filename + suffix)):
+            response = send_from_directory(app.config['ASSET_FOLDER'], filename + suffix, mimetype=mimetype,
+                                           max_age=app.config['ASSET_MAX_AGE'])
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(app.config['ASSET_FOLDER'], filename, max_age=app.config['ASSET_MAX_AGE'])
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route("/metrics")
+def metrics():
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/cache-stats")
+def cache_stats():
+    return jsonify({name: cache.stats() for name, cache in (('pages', page_cache), ('users', user_cache))})
+
+# Benchmarks. `flask bench` seeds the configured database, then drives the main
+# routes through the test client and a local threaded WSGI server and prints
+# latency percentiles and throughput as JSON. It refuses to run unless BLOG_DATABASE_URI points at
+# a scratch database. Seeding only adds the bench* users and posts that are missing, so repeated
+# runs measure the same data.
+BENCH_PASSWORD = 'benchmark'
+BENCH_SCRATCH_TITLE = 'Benchmark scratch post'  # posts created by the new_post scenario
+
+def seed_benchmark_data(users, posts, rng):
+    hashed = bcrypt.generate_password_hash(BENCH_PASSWORD, app.config['BCRYPT_LOG_ROUNDS']).decode('utf-8')
+    usernames = [f"bench{i}" for i in range(users)]
+    db.session.connection().execute(insert(User.__table__).prefix_with('OR IGNORE'), [
+        {'username': username, 'email': f"{username}@example.com", 'password': hashed} for username in usernames])
+    user_ids = db.session.scalars(select(User.id).where(User.username.in_(usernames)).order_by(User.id)).all()
+    existing = set(db.session.scalars(select(Post.title).where(Post.title.like('Benchmark post %'))))
+    start = datetime.utcnow()
+    for batch in batched(range(posts), 1000):
+        rows = []
+        for i in batch:
+            # Draw for every post, seeded or not, so the missing ones come out as a fresh seed would make them
+            content = ' '.join(rng.choice(('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'flask', 'blog'))
+                               for _ in range(rng.randint(20, 400)))
+            user_id = rng.choice(user_ids)
+            if f"Benchmark post {i}" in existing:
+                continue
+            date_posted = start - timedelta(minutes=i)
+            rows.append({'title': f"Benchmark post {i}", 'content': content, 'excerpt': make_excerpt(content),
+                         'user_id': user_id, 'date_posted': date_posted, 'updated_at': date_posted})
+        insert_post_rows(rows)
+        db.session.commit()
+
+def delete_bench_scratch_posts():
+    # Core deletes skip the FTS mapper events and post_count bookkeeping, so both are done here
+    rows = db.session.execute(select(Post.id, Post.user_id).where(Post.title == BENCH_SCRATCH_TITLE)).all()
+    conn = db.session.connection()
+    for batch in batched(rows, 500):
+        ids = [row.id for row in batch]
+        conn.execute(text('DELETE FROM post_fts WHERE rowid = :id'), [{'id': post_id} for post_id in ids])
+        conn.execute(Post.__table__.delete().where(Post.id.in_(ids)))
+        conn.execute(text('UPDATE user SET post_count = post_count - :removed WHERE id = :id'), [
+            {'id': user_id, 'removed': removed} for user_id, removed in Counter(row.user_id for row in batch).items()])
+    db.session.commit()
+
+def bench_row_counts():
+    return {'bench_users': db.session.scalar(select(db.func.count(User.id)).where(User.username.like('bench%'))),
+            'posts': db.session.scalar(select(db.func.count(Post.id)))}
+
+def bench_scenarios(rng):
+    post_ids = db.session.scalars(select(Post.id)).all()
+    usernames = db.session.scalars(select(User.username).where(User.username.like('bench%'))).all()
+    login_form = {'email': 'bench0@example.com', 'password': BENCH_PASSWORD}
+    # name -> (method, path, form data, expected status, needs a logged-in session, needs a fresh session)
+    return {
+        'home': lambda: ('GET', '/', None, 200, False, False),
+        'post': lambda: ('GET', f"/post/{rng.choice(post_ids)}", None, 200, False, False),
+        'user_posts': lambda: ('GET', f"/user/{rng.choice(usernames)}", None, 200, False, False),
+        'login': lambda: ('POST', '/login', login_form, 302, False, True),
+        'new_post': lambda: ('POST', '/post/new', {'title': BENCH_SCRATCH_TITLE, 'content': 'lorem ipsum ' * 50},
+                             302, True, False),
+    }, login_form
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, max(0, int(len(latencies) * p / 100 + 0.5) - 1))]
+
+def summarize(scenario, driver, latencies, errors, wall_seconds):
+    latencies = sorted(latencies)
+    result = {'scenario': scenario, 'driver': driver, 'requests': len(latencies) + errors, 'errors': errors,
+              'throughput_rps': round(len(latencies) / wall_seconds, 1) if wall_seconds else 0}
+    if latencies:
+        result.update({f"p{p}_ms": round(percentile(latencies, p) * 1000, 2) for p in (50, 95, 99)})
+        result['mean_ms'] = round(sum(latencies) / len(latencies) * 1000, 2)
+    return result
+
+def run_test_client(name, make_request, login_form, count):
+    client = app.test_client()
+    logged_in = app.test_client()
+    logged_in.post('/login', data=login_form)
+    latencies, errors = [], 0
+    wall_start = time.perf_counter()
+    for _ in range(count):
+        method, path, data, expected, needs_login, fresh = make_request()
+        c = app.test_client() if fresh else logged_in if needs_login else client
+        start = time.perf_counter()
+        response = c.open(path, method=method, data=data)
+        if response.status_code == expected:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+    return summarize(name, 'test_client', latencies, errors, time.perf_counter() - wall_start)
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+def run_http(name, make_request, login_form, count, concurrency, base_url):
+    local = threading.local()
+
+    def new_opener(login=False):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect)
+        if login:
+            send(opener, 'POST', '/login', login_form)
+        return opener
+
+    def send(opener, method, path, data):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with opener.open(urllib.request.Request(base_url + path, data=body, method=method)) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def one(_):
+        method, path, data, expected, needs_login, fresh = make_request()
+        if fresh:
+            opener = new_opener()
+        else:
+            if not hasattr(local, 'opener'):
+                local.opener = new_opener(login=needs_login)
+            opener = local.opener
+        start = time.perf_counter()
+        status = send(opener, method, path, data)
+        return time.perf_counter() - start, status == expected
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(count)))
+    wall = time.perf_counter() - wall_start
+    return summarize(name, 'http', [elapsed for elapsed, ok in results if ok],
+                     sum(1 for _, ok in results if not ok), wall)
+
+@app.cli.command('bench')
+@click.option('--users', default=50, show_default=True, help='Benchmark users to seed.')
+@click.option('--posts', default=5000, show_default=True, help='Benchmark posts to seed.')
+@click.option('--requests', 'count', default=200, show_default=True, help='Requests per scenario and driver.')
+@click.option('--concurrency', default=8, show_default=True, help='Concurrent clients for the HTTP driver.')
+@click.option('--scenario', 'selected', multiple=True, help='Only run these scenarios (repeatable).')
+@click.option('--reset', is_flag=True, help='Drop and recreate all tables before seeding.')
+@click.option('--page-cache/--no-page-cache', 'use_page_cache', default=True, show_default=True)
+@click.option('--seed', default=1, show_default=True, help='Random seed for data and request mix.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the JSON report here instead of stdout.')
+def bench_command(users, posts, count, concurrency, selected, reset, use_page_cache, seed, output):
+    """Seed the database and benchmark the main blog routes."""
+    if 'BLOG_DATABASE_URI' not in os.environ:
+        raise click.UsageError('Set BLOG_DATABASE_URI to a scratch database; bench writes to it and '
+                               '--reset drops every table.')
+    rng = random.Random(seed)
+    if reset:
+        db.drop_all()
+    migrate_db()
+    delete_bench_scratch_posts()
+    seed_benchmark_data(users, posts, rng)
+    rows = bench_row_counts()
+    app.config['PAGE_CACHE_ENABLED'] = use_page_cache
+    # The login scenario replays one account from one address, which is exactly what the throttle stops
+    app.config['LOGIN_RATE_LIMIT'] = False
+    scenarios, login_form = bench_scenarios(rng)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    results = []
+    # The CLI's app context would otherwise be shared by every test-client request (and its g),
+    # so that driver runs on its own thread like a real request would
+    driver_thread = ThreadPoolExecutor(max_workers=1)
+    try:
+        for name, make_request in scenarios.items():
+            if selected and name not in selected:
+                continue
+            results.append(driver_thread.submit(run_test_client, name, make_request, login_form, count).result())
+            results.append(run_http(name, make_request, login_form, count, concurrency, base_url))
+    finally:
+        driver_thread.shutdown()
+        server.shutdown()
+    report = json.dumps({
+        'config': {'users': users, 'posts': posts, 'requests': count, 'concurrency': concurrency,
+                   'page_cache': use_page_cache, 'seed': seed, 'database': app.config['SQLALCHEMY_DATABASE_URI'],
+                   'bcrypt_rounds': app.config['BCRYPT_LOG_ROUNDS']},
+        # What the scenarios actually ran against, which exceeds --users/--posts if earlier runs seeded more
+        'rows': rows,
+        'results': results,
+    }, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        migrate_db()
         # Create uploads directory if it doesn't exist
         if not os.path.exists(app.config['UPLOAD_FOLDER']):
             os.makedirs(app.config['UPLOAD_FOLDER'])
@@ -1,15 +1,143 @@
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
+from tkinter import ttk, messagebox, scrolledtext, simpledialog
 import json
 import base64
+import bisect
+import hashlib
+import hmac
 import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import pyperclip
 import secrets
 import string
 
+# Key derivation parameters are stored in the vault header. Vaults without them
+# were created with a fixed 100,000 PBKDF2-SHA256 iterations.
+LEGACY_KDF = {"algorithm": "pbkdf2-sha256", "iterations": 100000}
+KDF_TARGET_SECONDS = 0.5  # unlock time new vaults and master passwords are calibrated for
+
+class VaultStore:
+    """Credentials kept in SQLite, one separately encrypted row per (service, username).
+
+    Each row holds an HMAC of the service and username for lookups, the encrypted
+    service/username label and the encrypted password, so adding or deleting a
+    credential writes a single row and listing the vault never decrypts passwords.
+    Records use AES-GCM with the row's lookup as associated data, which keeps
+    opening a large vault fast and stops ciphertexts being swapped between rows.
+
+    Records are encrypted under a random data key. The meta table is the vault's
+    header: it holds the KDF salt and the data key wrapped by the key derived from
+    the master password, so changing the master password rewrites only the header.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS credentials (
+                id INTEGER PRIMARY KEY,
+                lookup BLOB NOT NULL UNIQUE,
+                label BLOB NOT NULL,
+                secret BLOB NOT NULL
+            );
+        """)
+        self.data_key = None
+        self.aead = None
+        self.mac_key = None
+
+    def get_meta(self, name):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    def kdf_params(self):
+        kdf = self.get_meta('kdf')
+        return json.loads(kdf) if kdf else LEGACY_KDF
+
+    def create(self, salt, key, kdf):
+        """Start an empty vault whose data key is wrapped by key, derived from the master password with salt and kdf."""
+        data_key = secrets.token_bytes(32)
+        with self.conn:
+            self.conn.execute("DELETE FROM credentials")
+            self.conn.execute("DELETE FROM meta")
+            self.set_meta('salt', salt)
+            self.set_meta('kdf', json.dumps(kdf))
+            self.set_meta('data_key', Fernet(key).encrypt(data_key))
+        self.use(data_key)
+
+    def use(self, data_key):
+        material = HKDF(algorithm=hashes.SHA256(), length=64, salt=None,
+                        info=b"password manager records").derive(data_key)
+        self.data_key = data_key
+        self.aead, self.mac_key = AESGCM(material[:32]), material[32:]
+
+    def unlock(self, key):
+        """Unwrap the data key with key; raises InvalidToken if it is not the vault's key."""
+        self.use(Fernet(key).decrypt(self.get_meta('data_key')))
+
+    def encrypt(self, data, lookup):
+        nonce = secrets.token_bytes(12)
+        return nonce + self.aead.encrypt(nonce, data, lookup)
+
+    def decrypt(self, blob, lookup):
+        return self.aead.decrypt(blob[:12], blob[12:], lookup)
+
+    def lookup(self, service, username):
+        return hmac.new(self.mac_key, json.dumps([service, username]).encode(), hashlib.sha256).digest()
+
+    def labels(self):
+        """Yield (service, username) for every credential without decrypting any password."""
+        for lookup, label in self.conn.execute("SELECT lookup, label FROM credentials"):
+            yield tuple(json.loads(self.decrypt(label, lookup)))
+
+    def items(self):
+        for lookup, label, secret in self.conn.execute("SELECT lookup, label, secret FROM credentials"):
+            service, username = json.loads(self.decrypt(label, lookup))
+            yield service, username, self.decrypt(secret, lookup).decode()
+
+    def get(self, service, username):
+        lookup = self.lookup(service, username)
+        row = self.conn.execute("SELECT secret FROM credentials WHERE lookup = ?", (lookup,)).fetchone()
+        return self.decrypt(row[0], lookup).decode() if row else None
+
+    def put(self, service, username, password):
+        self.put_many([(service, username, password)])
+
+    def put_many(self, items):
+        with self.conn:
+            self.write(items)
+
+    def write(self, items):
+        rows = []
+        for service, username, password in items:
+            lookup = self.lookup(service, username)
+            rows.append((lookup, self.encrypt(json.dumps([service, username]).encode(), lookup),
+                         self.encrypt(password.encode(), lookup)))
+        self.conn.executemany("""
+            INSERT INTO credentials (lookup, label, secret) VALUES (?, ?, ?)
+            ON CONFLICT (lookup) DO UPDATE SET label = excluded.label, secret = excluded.secret
+        """, rows)
+
+    def delete(self, service, username):
+        with self.conn:
+            self.conn.execute("DELETE FROM credentials WHERE lookup = ?", (self.lookup(service, username),))
+
+    def rewrap(self, salt, key, kdf):
+        """Wrap the data key under a new master key; the KDF settings and wrapped key change in one transaction."""
+        with self.conn:
+            self.set_meta('salt', salt)
+            self.set_meta('kdf', json.dumps(kdf))
+            self.set_meta('data_key', Fernet(key).encrypt(self.data_key))
+
 class PasswordManager:
     def __init__(self, root):
         self.root = root
@@ -18,9 +146,21 @@ class PasswordManager:
         self.root.resizable(True, True)
         
         self.master_password = None
-        self.fernet = None
+        self.vault_file = "passwords.db"
+        # Whole-vault files written by earlier versions, migrated on first login
         self.data_file = "passwords.encrypted"
         self.key_file = "key.key"
+        self.store = None
+        # Every credential as (service.lower(), username.lower(), service, username), in display order.
+        # The Treeview only ever holds the rows that fit on screen, filled from index[offset:].
+        self.index = []
+        self.offset = 0
+        self.page_size = 15
+        self.selected = None
+        self.revealed = set()
+        # Key derivation runs here so the Tk main loop keeps drawing while it works
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.busy = False
         
         self.setup_ui()
         
@@ -39,6 +179,12 @@ class PasswordManager:
         
         self.notebook.hide(1)
         
+        status_frame = ttk.Frame(self.root)
+        status_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+        self.status_var = tk.StringVar()
+        ttk.Label(status_frame, textvariable=self.status_var).pack(side=tk.LEFT)
+        self.progress = ttk.Progressbar(status_frame, mode="indeterminate", length=200)
+        
     def setup_login_frame(self):
         ttk.Label(self.login_frame, text="Master Password:", font=("Arial", 12)).grid(row=0, column=0, sticky=tk.W, pady=10)
         
@@ -86,17 +232,16 @@ class PasswordManager:
         ttk.Label(right_frame, text="Saved Passwords:").grid(row=0, column=0, sticky=tk.W, pady=5)
         
         columns = ("Service", "Username", "Password")
-        self.tree = ttk.Treeview(right_frame, columns=columns, show="headings", height=15)
+        self.tree = ttk.Treeview(right_frame, columns=columns, show="headings", height=self.page_size, selectmode="browse")
         
         for col in columns:
             self.tree.heading(col, text=col)
             self.tree.column(col, width=120)
         
-        scrollbar = ttk.Scrollbar(right_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.scrollbar = ttk.Scrollbar(right_frame, orient=tk.VERTICAL, command=self.scroll_list)
         
         self.tree.grid(row=1, column=0, sticky=tk.NSEW, pady=5)
-        scrollbar.grid(row=1, column=1, sticky=tk.NS)
+        self.scrollbar.grid(row=1, column=1, sticky=tk.NS)
         
         right_frame.columnconfigure(0, weight=1)
         right_frame.rowconfigure(1, weight=1)
@@ -109,17 +254,60 @@ class PasswordManager:
         ttk.Button(button_frame, text="Show Password", command=self.toggle_password_visibility).pack(side=tk.LEFT, padx=5)
         
         self.tree.bind('<<TreeviewSelect>>', self.on_item_select)
-        
-    def derive_key(self, password, salt):
+        self.tree.bind('<Configure>', self.on_list_resize)
+        self.tree.bind('<MouseWheel>', lambda event: self.scroll_list("scroll", -1 if event.delta > 0 else 1, "units"))
+        self.tree.bind('<Button-4>', lambda event: self.scroll_list("scroll", -1, "units"))
+        self.tree.bind('<Button-5>', lambda event: self.scroll_list("scroll", 1, "units"))
+        self.tree.bind('<Up>', lambda event: self.move_selection(-1))
+        self.tree.bind('<Down>', lambda event: self.move_selection(1))
+        self.tree.bind('<Prior>', lambda event: self.move_selection(-self.page_size))
+        self.tree.bind('<Next>', lambda event: self.move_selection(self.page_size))
+        
+    def derive_key(self, password, salt, params=LEGACY_KDF):
+        if params["algorithm"] != "pbkdf2-sha256":
+            raise ValueError(f"Unsupported key derivation: {params['algorithm']}")
+            
         kdf = PBKDF2HMAC(
             algorithm=hashes.SHA256(),
             length=32,
             salt=salt,
-            iterations=100000,
+            iterations=params["iterations"],
         )
         key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
         return key
         
+    def calibrate_kdf(self, target_seconds=KDF_TARGET_SECONDS):
+        """Pick the PBKDF2 iteration count that takes about target_seconds on this machine."""
+        sample = 50000
+        start = time.perf_counter()
+        self.derive_key("calibration", secrets.token_bytes(16), {"algorithm": "pbkdf2-sha256", "iterations": sample})
+        iterations = int(sample * target_seconds / (time.perf_counter() - start)) // 1000 * 1000
+        # Never weaker than the fixed count used before calibration existed
+        return {"algorithm": "pbkdf2-sha256", "iterations": max(iterations, LEGACY_KDF["iterations"])}
+        
+    def run_in_background(self, message, work, on_done):
+        """Run work() on the worker thread with the progress bar showing, then on_done(future) on the Tk thread."""
+        if self.busy:
+            return
+            
+        self.busy = True
+        self.status_var.set(message)
+        self.progress.pack(side=tk.RIGHT)
+        self.progress.start(10)
+        future = self.executor.submit(work)
+        self.root.after(50, self.finish_background, future, on_done)
+        
+    def finish_background(self, future, on_done):
+        if not future.done():
+            self.root.after(50, self.finish_background, future, on_done)
+            return
+            
+        self.progress.stop()
+        self.progress.pack_forget()
+        self.status_var.set("")
+        self.busy = False
+        on_done(future)
+        
     def create_new_vault(self):
         password = self.master_pwd_var.get()
         if not password:
@@ -127,15 +315,25 @@ class PasswordManager:
             return
             
         salt = secrets.token_bytes(16)
-        key = self.derive_key(password, salt)
-        self.fernet = Fernet(key)
         
-        with open(self.key_file, 'wb') as f:
-            f.write(salt)
+        def work():
+            kdf = self.calibrate_kdf()
+            return kdf, self.derive_key(password, salt, kdf)
+            
+        self.run_in_background("Creating vault...", work,
+                               lambda future: self.finish_create_vault(password, salt, future))
+        
+    def finish_create_vault(self, password, salt, future):
+        try:
+            kdf, key = future.result()
+            self.store = VaultStore(self.vault_file)
+            self.store.create(salt, key, kdf)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to create vault: {str(e)}")
+            return
             
         self.master_password = password
-        self.passwords = {}
-        self.save_data()
+        self.load_index([])
         
         messagebox.showinfo("Success", "New vault created successfully")
         self.notebook.hide(0)
@@ -147,40 +345,62 @@ class PasswordManager:
             messagebox.showerror("Error", "Please enter the master password")
             return
             
-        if not os.path.exists(self.key_file) or not os.path.exists(self.data_file):
+        legacy = os.path.exists(self.key_file) and os.path.exists(self.data_file)
+        if not os.path.exists(self.vault_file) and not legacy:
             messagebox.showerror("Error", "No vault found. Please create a new vault.")
             return
             
         try:
-            with open(self.key_file, 'rb') as f:
-                salt = f.read()
-                
-            key = self.derive_key(password, salt)
-            self.fernet = Fernet(key)
+            if os.path.exists(self.vault_file):
+                store = VaultStore(self.vault_file)
+                salt, kdf = store.get_meta('salt'), store.kdf_params()
+            else:
+                store = None
+                with open(self.key_file, 'rb') as f:
+                    salt = f.read()
+                kdf = LEGACY_KDF
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open vault: {str(e)}")
+            return
             
-            with open(self.data_file, 'rb') as f:
-                encrypted_data = f.read()
-                
-            decrypted_data = self.fernet.decrypt(encrypted_data)
-            self.passwords = json.loads(decrypted_data.decode())
+        self.run_in_background("Unlocking vault...", lambda: self.derive_key(password, salt, kdf),
+                               lambda future: self.finish_login(password, store, salt, future))
+        
+    def finish_login(self, password, store, salt, future):
+        try:
+            key = future.result()
+            if store:
+                store.unlock(key)
+                self.store = store
+            else:
+                self.migrate_legacy_vault(salt, key)
             
+            self.load_index(self.store.labels())
             self.master_password = password
             self.notebook.hide(0)
             self.notebook.select(1)
-            self.update_treeview()
             
         except Exception as e:
             messagebox.showerror("Error", f"Invalid master password: {str(e)}")
             
-    def save_data(self):
-        if not self.fernet:
-            return
+    def migrate_legacy_vault(self, salt, key):
+        with open(self.data_file, 'rb') as f:
+            passwords = json.loads(Fernet(key).decrypt(f.read()).decode())
             
-        data = json.dumps(self.passwords).encode()
-        encrypted_data = self.fernet.encrypt(data)
-        
-        with open(self.data_file, 'wb') as f:
-            f.write(encrypted_data)
+        store = VaultStore(self.vault_file + ".tmp")
+        store.create(salt, key, LEGACY_KDF)
+        store.put_many((service, username, pwd)
+                       for service, credentials in passwords.items() for username, pwd in credentials.items())
+        store.conn.close()
+        os.replace(self.vault_file + ".tmp", self.vault_file)
+        # Keep the old files around rather than deleting the only other copy of the vault
+        os.replace(self.data_file, self.data_file + ".bak")
+        os.replace(self.key_file, self.key_file + ".bak")
+        self.store = VaultStore(self.vault_file)
+        self.store.unlock(key)
+        
+    def selected_entry(self):
+        return self.selected[2:] if self.selected else None
             
     def save_password(self):
         service = self.service_var.get().strip()
@@ -191,12 +411,8 @@ class PasswordManager:
             messagebox.showerror("Error", "Please fill in all fields")
             return
             
-        if service not in self.passwords:
-            self.passwords[service] = {}
-            
-        self.passwords[service][username] = password
-        self.save_data()
-        self.update_treeview()
+        self.store.put(service, username, password)
+        self.add_entry(service, username)
         
         self.service_var.set("")
         self.username_var.set("")
@@ -205,87 +421,154 @@ class PasswordManager:
         messagebox.showinfo("Success", "Password saved successfully")
         
     def delete_password(self):
-        selected = self.tree.selection()
-        if not selected:
+        entry = self.selected_entry()
+        if not entry:
             messagebox.showerror("Error", "Please select a password to delete")
             return
             
-        item = self.tree.item(selected[0])
-        service = item['values'][0]
-        username = item['values'][1]
-        
-        if service in self.passwords and username in self.passwords[service]:
-            del self.passwords[service][username]
-            if not self.passwords[service]:
-                del self.passwords[service]
-                
-            self.save_data()
-            self.update_treeview()
-            messagebox.showinfo("Success", "Password deleted successfully")
+        # remove_entry() clears the selection, so a selected entry is always still in the index
+        self.store.delete(*entry)
+        self.remove_entry(*entry)
+        messagebox.showinfo("Success", "Password deleted successfully")
             
+    @staticmethod
+    def index_key(service, username):
+        return service.lower(), username.lower(), service, username
+        
+    def load_index(self, entries):
+        self.index = sorted(self.index_key(service, username) for service, username in entries)
+        self.offset = 0
+        self.selected = None
+        self.revealed = set()
+        self.update_treeview()
+        
+    def add_entry(self, service, username):
+        key = self.index_key(service, username)
+        position = bisect.bisect_left(self.index, key)
+        if position == len(self.index) or self.index[position] != key:
+            self.index.insert(position, key)
+        self.update_treeview()
+        
+    def add_entries(self, entries):
+        # Merging a batch is one sort rather than an insert per entry
+        self.index = sorted(set(self.index).union(self.index_key(service, username) for service, username in entries))
+        self.update_treeview()
+        
+    def remove_entry(self, service, username):
+        key = self.index_key(service, username)
+        position = bisect.bisect_left(self.index, key)
+        if position < len(self.index) and self.index[position] == key:
+            del self.index[position]
+        self.revealed.discard(key)
+        if self.selected == key:
+            self.selected = None
+        self.update_treeview()
+        
     def update_treeview(self):
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        """Fill the on-screen rows from the index, reusing the existing Treeview items."""
+        self.offset = max(0, min(self.offset, len(self.index) - self.page_size))
+        window = self.index[self.offset:self.offset + self.page_size]
+        rows = self.tree.get_children()
+        for i, key in enumerate(window):
+            password = self.store.get(key[2], key[3]) if key in self.revealed else "•" * 12
+            if i < len(rows):
+                self.tree.item(rows[i], values=(key[2], key[3], password))
+            else:
+                self.tree.insert("", tk.END, iid=f"row{i}", values=(key[2], key[3], password))
+        if len(rows) > len(window):
+            self.tree.delete(*rows[len(window):])
             
-        for service, credentials in self.passwords.items():
-            for username, password in credentials.items():
-                self.tree.insert("", tk.END, values=(service, username, "•" * 12))
-                
+        if self.selected in window:
+            self.tree.selection_set(f"row{window.index(self.selected)}")
+        elif self.tree.selection():
+            self.tree.selection_remove(*self.tree.selection())
+            
+        if self.index:
+            self.scrollbar.set(self.offset / len(self.index), (self.offset + len(window)) / len(self.index))
+        else:
+            self.scrollbar.set(0, 1)
+            
+    def scroll_list(self, action, amount, unit=None):
+        if action == "moveto":
+            self.offset = int(float(amount) * len(self.index))
+        else:
+            self.offset += int(amount) * (self.page_size if unit == "pages" else 1)
+        self.update_treeview()
+        
+    def on_list_resize(self, event):
+        rows = self.tree.get_children()
+        box = self.tree.bbox(rows[0]) if rows else None
+        if not box:
+            return
+            
+        # bbox gives the heading height (y) and the row height
+        page_size = max(1, (event.height - box[1]) // box[3])
+        if page_size != self.page_size:
+            self.page_size = page_size
+            self.update_treeview()
+            
+    def move_selection(self, step):
+        if self.index:
+            position = bisect.bisect_left(self.index, self.selected) + step if self.selected else 0
+            self.select(self.index[max(0, min(position, len(self.index) - 1))])
+        return "break"
+        
+    def select(self, key):
+        """Select key, scrolling it into view, and load it into the form."""
+        self.selected = key
+        position = bisect.bisect_left(self.index, key)
+        if position < self.offset:
+            self.offset = position
+        elif position >= self.offset + self.page_size:
+            self.offset = position - self.page_size + 1
+        self.update_treeview()
+        
+        self.service_var.set(key[2])
+        self.username_var.set(key[3])
+        password = self.store.get(key[2], key[3])
+        if password is not None:
+            self.password_var.set(password)
+        
     def on_item_select(self, event):
         selected = self.tree.selection()
         if not selected:
             return
             
-        item = self.tree.item(selected[0])
-        self.service_var.set(item['values'][0])
-        self.username_var.set(item['values'][1])
-        
-        service = item['values'][0]
-        username = item['values'][1]
-        if service in self.passwords and username in self.passwords[service]:
-            self.password_var.set(self.passwords[service][username])
+        key = self.index[self.offset + self.tree.index(selected[0])]
+        # Re-selecting the same entry after a scroll must not overwrite edits in the form
+        if key != self.selected:
+            self.select(key)
             
     def copy_username(self):
-        selected = self.tree.selection()
-        if not selected:
+        entry = self.selected_entry()
+        if not entry:
             messagebox.showerror("Error", "Please select an entry first")
             return
             
-        item = self.tree.item(selected[0])
-        username = item['values'][1]
+        username = entry[1]
         pyperclip.copy(username)
         messagebox.showinfo("Success", "Username copied to clipboard")
         
     def copy_password(self):
-        selected = self.tree.selection()
-        if not selected:
+        entry = self.selected_entry()
+        if not entry:
             messagebox.showerror("Error", "Please select an entry first")
             return
             
-        item = self.tree.item(selected[0])
-        service = item['values'][0]
-        username = item['values'][1]
-        
-        if service in self.passwords and username in self.passwords[service]:
-            password = self.passwords[service][username]
+        password = self.store.get(*entry)
+        if password is not None:
             pyperclip.copy(password)
             messagebox.showinfo("Success", "Password copied to clipboard")
             
     def toggle_password_visibility(self):
-        selected = self.tree.selection()
-        if not selected:
+        if not self.selected:
             return
             
-        item = self.tree.item(selected[0])
-        service = item['values'][0]
-        username = item['values'][1]
-        
-        if service in self.passwords and username in self.passwords[service]:
-            password = self.passwords[service][username]
-            if item['values'][2] == "•" * 12:
-                self.tree.set(selected[0], "Password", password)
-            else:
-                self.tree.set(selected[0], "Password", "•" * 12)
+        if self.selected in self.revealed:
+            self.revealed.discard(self.selected)
+        else:
+            self.revealed.add(self.selected)
+        self.update_treeview()
                 
     def generate_password(self):
         length = 16
@@ -296,13 +579,17 @@ class PasswordManager:
         messagebox.showinfo("Password Generated", "A strong password has been generated and copied to clipboard")
         
     def export_passwords(self):
-        if not self.passwords:
+        if not self.index:
             messagebox.showerror("Error", "No passwords to export")
             return
             
         try:
+            passwords = {}
+            for service, username, password in self.store.items():
+                passwords.setdefault(service, {})[username] = password
+                
             with open("passwords_export.json", "w") as f:
-                json.dump(self.passwords, f, indent=4)
+                json.dump(passwords, f, indent=4)
                 
             messagebox.showinfo("Success", "Passwords exported to passwords_export.json")
         except Exception as e:
@@ -313,38 +600,37 @@ class PasswordManager:
             with open("passwords_export.json", "r") as f:
                 imported_passwords = json.load(f)
                 
-            for service, credentials in imported_passwords.items():
-                if service not in self.passwords:
-                    self.passwords[service] = {}
-                    
-                for username, password in credentials.items():
-                    self.passwords[service][username] = password
-                    
-            self.save_data()
-            self.update_treeview()
+            items = [(service, username, password)
+                     for service, credentials in imported_passwords.items()
+                     for username, password in credentials.items()]
+            self.store.put_many(items)
+            self.add_entries((service, username) for service, username, _ in items)
             messagebox.showinfo("Success", "Passwords imported successfully")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to import passwords: {str(e)}")
             
     def change_master_password(self):
-        new_password = tk.simpledialog.askstring("Change Master Password", "Enter new master password:", show="•")
+        new_password = simpledialog.askstring("Change Master Password", "Enter new master password:", show="•")
         if not new_password:
             return
             
         salt = secrets.token_bytes(16)
-        key = self.derive_key(new_password, salt)
-        new_fernet = Fernet(key)
         
-        with open(self.key_file, 'wb') as f:
-            f.write(salt)
+        def work():
+            kdf = self.calibrate_kdf()
+            return kdf, self.derive_key(new_password, salt, kdf)
             
-        data = json.dumps(self.passwords).encode()
-        encrypted_data = new_fernet.encrypt(data)
+        self.run_in_background("Changing master password...", work,
+                               lambda future: self.finish_change_master_password(new_password, salt, future))
         
-        with open(self.data_file, 'wb') as f:
-            f.write(encrypted_data)
+    def finish_change_master_password(self, new_password, salt, future):
+        try:
+            kdf, key = future.result()
+            self.store.rewrap(salt, key, kdf)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to change master password: {str(e)}")
+            return
             
-        self.fernet = new_fernet
         self.master_password = new_password
         
         messagebox.showinfo("Success", "Master password changed successfully")
@@ -0,0 +1,261 @@
+import io
+import os
+import random
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+
+import pytest
+from PIL import Image
+from sqlalchemy import event
+from werkzeug.serving import make_server
+
+# The app builds its engine from BLOG_DATABASE_URI at import time, so point it at a scratch file first
+os.environ['BLOG_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'blog.db')
+
+import blog_single_file as blog
+from blog_single_file import app, db
+
+def reset_db():
+    with app.app_context():
+        db.drop_all()
+        blog.migrate_db()
+    blog.page_cache.clear()
+    blog.user_cache.clear()
+    blog.forget_post_totals()
+
+@pytest.fixture
+def seeded():
+    app.config.update(BCRYPT_LOG_ROUNDS=4, LOGIN_RATE_LIMIT=False)
+    reset_db()
+    with app.app_context():
+        blog.seed_benchmark_data(4, 200, random.Random(0))
+
+@pytest.fixture
+def no_page_cache(monkeypatch):
+    # Every request should reach the database rather than the page cache
+    monkeypatch.setitem(app.config, 'PAGE_CACHE_ENABLED', False)
+
+@pytest.fixture
+def live_server(seeded, no_page_cache):
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+def send(opener, base_url, method, path, data=None):
+    body = urllib.parse.urlencode(data).encode() if data is not None else None
+    try:
+        with opener.open(urllib.request.Request(base_url + path, data=body, method=method)) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def test_parallel_readers_and_writers(live_server):
+    with app.app_context():
+        post_ids = db.session.scalars(db.select(blog.Post.id)).all()
+        posts_before = len(post_ids)
+    readers, reads, writers, writes = 6, 40, 4, 10
+
+    def read(seed):
+        rng = random.Random(seed)
+        opener = urllib.request.build_opener(blog.NoRedirect)
+        paths = ['/', '/api/posts', '/search?q=lorem', '/feed.xml']
+        return [(path, send(opener, live_server, 'GET', path))
+                for path in (rng.choice(paths + [f"/post/{rng.choice(post_ids)}"]) for _ in range(reads))]
+
+    def write(number):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), blog.NoRedirect)
+        assert send(opener, live_server, 'POST', '/login',
+                    {'email': f"bench{number}@example.com", 'password': blog.BENCH_PASSWORD}) == 302
+        return [('/post/new', send(opener, live_server, 'POST', '/post/new',
+                                   {'title': f"Writer {number} post {i}", 'content': 'lorem ipsum ' * 50}))
+                for i in range(writes)]
+
+    with ThreadPoolExecutor(max_workers=readers + writers) as pool:
+        read_results = pool.map(read, range(readers))
+        write_results = pool.map(write, range(writers))
+        read_statuses = [result for batch in read_results for result in batch]
+        write_statuses = [result for batch in write_results for result in batch]
+
+    # A "database is locked" error surfaces as a 500 from whichever request hit it
+    assert [result for result in read_statuses if result[1] != 200] == []
+    assert [result for result in write_statuses if result[1] != 302] == []
+    with app.app_context():
+        assert db.session.scalar(db.select(db.func.count(blog.Post.id))) == posts_before + writers * writes
+
+def create_posts(authors):
+    """A fresh database holding one page of posts spread round-robin over `authors` users."""
+    reset_db()
+    with app.app_context():
+        users = [blog.User(username=f"author{i}", email=f"author{i}@example.com", password='unused')
+                 for i in range(authors)]
+        for i in range(app.config['POSTS_PER_PAGE']):
+            post = blog.Post(title=f"Post {i}", author=users[i % authors])
+            blog.set_post_content(post, f"Body of post {i}")
+            db.session.add(post)
+        db.session.commit()
+
+def count_queries(path):
+    with app.app_context():
+        engine = db.engine
+    queries = []
+    def count(*args):
+        queries.append(args[2])
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        response = app.test_client().get(path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert response.status_code == 200
+    return len(queries)
+
+@pytest.mark.parametrize('path', ['/', '/user/author0', '/post/1'])
+def test_page_query_count_does_not_grow_with_authors(no_page_cache, path):
+    counts = []
+    for authors in (1, app.config['POSTS_PER_PAGE']):
+        create_posts(authors)
+        blog.forget_post_totals()
+        counts.append(count_queries(path))
+    assert counts[0] == counts[1]
+
+def test_oversized_avatar_is_rejected(seeded, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'AVATAR_FOLDER', str(tmp_path))
+    client = app.test_client()
+    client.post('/login', data={'email': 'bench0@example.com', 'password': blog.BENCH_PASSWORD})
+    upload = io.BytesIO()
+    Image.new('1', (5000, 5000)).save(upload, 'PNG')
+    upload.seek(0)
+    response = client.post('/account', data={'username': 'bench0', 'email': 'bench0@example.com',
+                                              'picture': (upload, 'bomb.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert os.listdir(tmp_path) == []
+
+def test_bench_seeding_is_idempotent(seeded):
+    with app.app_context():
+        blog.seed_benchmark_data(4, 250, random.Random(0))
+        first = db.session.execute(db.select(blog.Post.title, blog.Post.content, blog.Post.user_id)
+                                   .order_by(blog.Post.title)).all()
+        blog.seed_benchmark_data(4, 250, random.Random(0))
+        assert blog.bench_row_counts() == {'bench_users': 4, 'posts': 250}
+        assert db.session.execute(db.select(blog.Post.title, blog.Post.content, blog.Post.user_id)
+                                  .order_by(blog.Post.title)).all() == first
+
+def test_bench_refuses_the_default_database(monkeypatch):
+    monkeypatch.delenv('BLOG_DATABASE_URI')
+    result = app.test_cli_runner().invoke(args=['bench', '--reset'])
+    assert result.exit_code == 2
+    assert 'BLOG_DATABASE_URI' in result.output
+
+def test_rejected_account_form_writes_no_avatar(seeded, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'AVATAR_FOLDER', str(tmp_path))
+    client = app.test_client()
+    client.post('/login', data={'email': 'bench0@example.com', 'password': blog.BENCH_PASSWORD})
+    upload = io.BytesIO()
+    Image.new('RGB', (64, 64)).save(upload, 'PNG')
+    upload.seek(0)
+    response = client.post('/account', data={'username': 'bench1', 'email': 'bench0@example.com',
+                                              'picture': (upload, 'avatar.png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert os.listdir(tmp_path) == []
+
+def test_render_posts_changes_post_validators(seeded):
+    client = app.test_client()
+    with app.app_context():
+        post_id = db.session.scalar(db.select(blog.Post.id).limit(1))
+    first = client.get(f"/post/{post_id}")
+    result = app.test_cli_runner().invoke(args=['render-posts', '--all'])
+    assert result.exit_code == 0
+    blog.page_cache.clear()
+    second = client.get(f"/post/{post_id}", headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.headers['ETag'] != first.headers['ETag']
+
+@pytest.mark.parametrize('path', ['/feed.xml', '/sitemap.xml'])
+def test_forged_host_does_not_poison_cached_xml(seeded, path):
+    client = app.test_client()
+    forged = client.get(path, headers={'Host': 'evil.example'})
+    assert b'http://evil.example/' in forged.data
+    response = client.get(path)
+    assert b'evil.example' not in response.data
+    assert b'http://localhost/' in response.data
+
+def test_site_url_overrides_host(seeded, monkeypatch):
+    monkeypatch.setitem(app.config, 'SITE_URL', 'https://blog.example.com/')
+    response = app.test_client().get('/feed.xml', headers={'Host': 'evil.example'})
+    assert response.mimetype == 'application/atom+xml'
+    assert b'evil.example' not in response.data
+    assert b'https://blog.example.com/post/' in response.data
+
+def test_ip_throttled_logins_do_not_spend_account_tokens(seeded, monkeypatch):
+    monkeypatch.setitem(app.config, 'LOGIN_RATE_LIMIT', True)
+    monkeypatch.setitem(app.config, 'LOGIN_IP_BURST', 2)
+    monkeypatch.setitem(app.config, 'LOGIN_ACCOUNT_BURST', 3)
+    blog.login_limiter.clear()
+    form = {'email': 'bench0@example.com', 'password': 'wrong'}
+    attacker = app.test_client()
+    statuses = [attacker.post('/login', data=form, environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code
+                for _ in range(5)]
+    assert statuses == [200, 200, 429, 429, 429]
+    other = app.test_client().post('/login', data=form, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert other.status_code == 200
+    blog.login_limiter.clear()
+
+def test_successful_logins_do_not_spend_account_tokens(seeded, monkeypatch):
+    monkeypatch.setitem(app.config, 'LOGIN_RATE_LIMIT', True)
+    monkeypatch.setitem(app.config, 'LOGIN_ACCOUNT_BURST', 2)
+    blog.login_limiter.clear()
+    good = {'email': 'bench0@example.com', 'password': blog.BENCH_PASSWORD}
+    bad = {'email': 'bench0@example.com', 'password': 'wrong'}
+    # Each login comes from a fresh client and address so only the account bucket is in play
+    def attempt(number, form):
+        return app.test_client().post('/login', data=form,
+                                      environ_base={'REMOTE_ADDR': f"10.0.1.{number}"}).status_code
+    assert [attempt(i, good) for i in range(5)] == [302] * 5
+    assert [attempt(10 + i, bad) for i in range(3)] == [200, 200, 429]
+    blog.login_limiter.clear()
+
+def test_cache_drops_values_built_before_an_invalidation():
+    cache = blog.MemoryCache(10)
+    since = cache.token()
+    cache.invalidate('posts')
+    cache.set('page', 'stale', 60, ['posts'], since)
+    cache.set('other', 'fresh', 60, ['user:1'], since)
+    assert cache.get('page') is None
+    assert cache.get('other') == 'fresh'
+    since = cache.token()
+    cache.set('page', 'current', 60, ['posts'], since)
+    assert cache.get('page') == 'current'
+
+def test_page_rendered_across_a_post_write_is_not_cached(seeded, monkeypatch):
+    page_validators = blog.page_validators
+    def write_during_render(*args):
+        # Another request commits a post after this one has read the listing
+        blog.posts_changed(1)
+        return page_validators(*args)
+    monkeypatch.setattr(blog, 'page_validators', write_during_render)
+    app.test_client().get('/')
+    monkeypatch.setattr(blog, 'page_validators', page_validators)
+    misses = blog.page_cache.stats()['misses']
+    app.test_client().get('/')
+    assert blog.page_cache.stats()['misses'] == misses + 1
+
+def test_user_row_read_before_an_account_change_is_not_cached(seeded):
+    def change_during_load(*args):
+        # account() commits and invalidates while this cache miss is reading the old row
+        blog.user_cache.invalidate('user:1')
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', change_during_load)
+    try:
+        with app.test_request_context():
+            assert blog.load_user('1') is not None
+    finally:
+        event.remove(engine, 'before_cursor_execute', change_during_load)
+    assert blog.user_cache.get(1) is None